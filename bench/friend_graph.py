@@ -0,0 +1,146 @@
+"""
+Бенчмарк FriendGraph на синтетическом графе (по умолчанию 1M ребер).
+
+    python bench/friend_graph.py --users 50000 --edges 1000000 -o friend_graph.json
+    python bench/friend_graph.py --no-sql
+
+Меряет загрузку и память графа, проверку дружбы, общих друзей,
+рекомендации и обновления. Для сравнения те же запросы выполняются через
+SQL по таблице friends в SQLite (обе стороны ребра, PK (user_id, friend_id)),
+как их выполнял бы сервер без графа.
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from friend_graph import FriendGraph  # noqa: E402
+
+def synthetic_edges(rng, users, edges):
+    """Неориентированные ребра со скошенными степенями: часть узлов - «хабы»."""
+    ids = [str(uuid.UUID(int=rng.getrandbits(128), version=4)) for _ in range(users)]
+    pick = lambda: ids[int(users * rng.random() ** 2)]
+    pairs = set()
+    while len(pairs) < edges:
+        a, b = pick(), ids[rng.randrange(users)]
+        if a != b:
+            pairs.add((a, b) if a < b else (b, a))
+    return ids, list(pairs)
+
+def timed(fn, args_list):
+    """(ops/s, p50 мс, p99 мс) по вызовам fn(*args) для каждого набора аргументов."""
+    samples = []
+    for args in args_list:
+        started = time.perf_counter()
+        fn(*args)
+        samples.append(time.perf_counter() - started)
+    samples.sort()
+    total = sum(samples)
+    return {
+        'ops_per_s': round(len(samples) / total, 1) if total else None,
+        'p50_ms': round(samples[len(samples) // 2] * 1000, 4),
+        'p99_ms': round(samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1000, 4),
+    }
+
+def sqlite_friends(pairs):
+    path = os.path.join(tempfile.mkdtemp(prefix='neural-graph-'), 'friends.db')
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE friends (user_id VARCHAR(36), friend_id VARCHAR(36), PRIMARY KEY (user_id, friend_id))")
+    conn.executemany("INSERT INTO friends VALUES (?, ?)", pairs)
+    conn.executemany("INSERT INTO friends VALUES (?, ?)", ((b, a) for a, b in pairs))
+    conn.commit()
+    return conn, path
+
+SQL_QUERIES = {
+    'are_friends': "SELECT 1 FROM friends WHERE user_id = ? AND friend_id = ?",
+    'mutual_friends': """SELECT a.friend_id FROM friends a JOIN friends b ON a.friend_id = b.friend_id
+                         WHERE a.user_id = ? AND b.user_id = ?""",
+    'suggestions': """SELECT f2.friend_id, COUNT(*) AS mutual FROM friends f1
+                      JOIN friends f2 ON f2.user_id = f1.friend_id
+                      WHERE f1.user_id = ? AND f2.friend_id != ?
+                        AND f2.friend_id NOT IN (SELECT friend_id FROM friends WHERE user_id = ?)
+                      GROUP BY f2.friend_id ORDER BY mutual DESC LIMIT 10""",
+}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=50000)
+    parser.add_argument('--edges', type=int, default=1000000)
+    parser.add_argument('--ops', type=int, default=20000, help='вызовов на операцию (рекомендации - /20)')
+    parser.add_argument('--no-sql', action='store_true', help='не сравнивать с SQLite')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('-o', '--output')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    print(f"--- GENERATING {args.edges} EDGES OVER {args.users} USERS ---")
+    ids, pairs = synthetic_edges(rng, args.users, args.edges)
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    graph = FriendGraph.from_edges(pairs)
+    load_s = time.perf_counter() - started
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    sample_pairs = [(rng.choice(ids), rng.choice(ids)) for _ in range(args.ops)]
+    edge_pairs = rng.sample(pairs, min(args.ops, len(pairs)))
+    users_sample = [(rng.choice(ids),) for _ in range(max(1, args.ops // 20))]
+
+    report = {
+        'graph': {**graph.stats(), 'load_s': round(load_s, 2),
+                  'memory_mb': round(current / 2 ** 20, 1), 'peak_load_memory_mb': round(peak / 2 ** 20, 1),
+                  'max_degree': max(graph.degree(u) for u in ids)},
+        'memory': {},
+        'sql': {},
+    }
+    memory = report['memory']
+    memory['are_friends'] = timed(graph.are_friends, sample_pairs + edge_pairs)
+    memory['mutual_friends'] = timed(graph.mutual_friends, edge_pairs)
+    memory['suggestions'] = timed(lambda u: graph.suggestions(u, limit=10), users_sample)
+
+    updates = edge_pairs[:5000]
+    started = time.perf_counter()
+    for a, b in updates:
+        graph.remove(a, b)
+    for a, b in updates:
+        graph.add(a, b)
+    memory['remove_add'] = {'ops_per_s': round(2 * len(updates) / (time.perf_counter() - started), 1)}
+
+    if not args.no_sql:
+        print("--- LOADING SQLITE FOR COMPARISON ---")
+        conn, path = sqlite_friends(pairs)
+        sql = report['sql']
+        sql['are_friends'] = timed(lambda a, b: conn.execute(SQL_QUERIES['are_friends'], (a, b)).fetchone(),
+                                   sample_pairs + edge_pairs)
+        sql['mutual_friends'] = timed(lambda a, b: conn.execute(SQL_QUERIES['mutual_friends'], (a, b)).fetchall(),
+                                      edge_pairs)
+        sql['suggestions'] = timed(lambda u: conn.execute(SQL_QUERIES['suggestions'], (u, u, u)).fetchall(),
+                                   users_sample)
+        conn.close()
+        os.remove(path)
+
+    g = report['graph']
+    print(f"graph: {g['users']} users, {g['edges']} edges, max degree {g['max_degree']}, "
+          f"loaded in {g['load_s']}s, {g['memory_mb']} MB (peak {g['peak_load_memory_mb']} MB)")
+    print(f"{'operation':<16}{'memory ops/s':>14}{'p99 ms':>10}{'sql ops/s':>12}{'p99 ms':>10}")
+    for name, m in memory.items():
+        s = report['sql'].get(name, {})
+        print(f"{name:<16}{m['ops_per_s']:>14}{m.get('p99_ms', '-'):>10}"
+              f"{s.get('ops_per_s', '-'):>12}{s.get('p99_ms', '-'):>10}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"--- RESULTS SAVED TO {args.output} ---")
+
+if __name__ == '__main__':
+    main()
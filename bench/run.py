@@ -0,0 +1,240 @@
+"""
+Нагрузочный прогон эндпоинтов по базе, заполненной bench/seed.py.
+
+    DATABASE_URL=sqlite:////tmp/bench.db python bench/run.py --clients 8 --requests 400 -o before.json
+    DATABASE_URL=sqlite:////tmp/bench.db python bench/run.py -o after.json --compare before.json
+    python bench/run.py --url http://localhost:5000 --only feed,profile
+
+По умолчанию приложение поднимается в процессе (test_client на поток), и
+число SQL-выражений на запрос считается слушателем событий движка. С --url
+запросы идут по HTTP к запущенному серверу; тогда число запросов к БД
+берется из заголовка Server-Timing, если сервер его отдает.
+Для каждого сценария: пропускная способность, p50/p95/p99, ошибки и SQL/запрос.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from seed import TOKEN_PREFIX, bench_token  # noqa: E402
+
+# Сценарий: имя -> функция (rng, ctx) -> (method, path, body)
+# ctx содержит токен клиента и выборки идентификаторов из базы
+SCENARIOS = {
+    'feed': lambda rng, ctx: ('GET', '/api/posts?limit=20', None),
+    'trending': lambda rng, ctx: ('GET', '/api/posts/trending', None),
+    'timeline': lambda rng, ctx: ('GET', '/api/timeline?limit=20', None),
+    'feed_page': lambda rng, ctx: ('GET', f"/api/posts?limit=20&before={ctx['cursor']}", None),
+    'post_search': lambda rng, ctx: ('GET', f"/api/posts/search?q={rng.choice(('neural', 'сеть', 'pulse'))}", None),
+    'user_search': lambda rng, ctx: ('GET', f"/api/search?q=bench_{rng.randrange(ctx['users'])}", None),
+    'profile': lambda rng, ctx: ('GET', f"/api/users/{rng.choice(ctx['handles'])}", None),
+    'profile_posts': lambda rng, ctx: ('GET', f"/api/users/{rng.choice(ctx['handles'])}/posts", None),
+    'profile_friends': lambda rng, ctx: ('GET', f"/api/users/{rng.choice(ctx['handles'])}/friends", None),
+    'friend_requests': lambda rng, ctx: ('GET', '/api/friends/requests', None),
+    'friend_requests_count': lambda rng, ctx: ('GET', '/api/friends/requests?count_only=1', None),
+    'friend_suggestions': lambda rng, ctx: ('GET', '/api/friends/suggestions', None),
+    'mutual_friends': lambda rng, ctx: ('GET', f"/api/users/{rng.choice(ctx['handles'])}/mutual", None),
+    'messages_public': lambda rng, ctx: ('GET', '/api/messages', None),
+    'messages_dm': lambda rng, ctx: ('GET', f"/api/messages?partner_id={rng.choice(ctx['user_ids'])}", None),
+    'poll': lambda rng, ctx: ('GET', '/api/poll', None),
+    'music': lambda rng, ctx: ('GET', '/api/music', None),
+    'like': lambda rng, ctx: (rng.choice(('PUT', 'DELETE')), f"/api/posts/{rng.choice(ctx['post_ids'])}/like", None),
+    'comment': lambda rng, ctx: ('POST', f"/api/posts/{rng.choice(ctx['post_ids'])}/comments", {'content': 'bench'}),
+    'post': lambda rng, ctx: ('POST', '/api/posts', {'content': 'bench post'}),
+    'message_send': lambda rng, ctx: ('POST', '/api/messages', {'text': 'bench', 'recipientId': rng.choice(ctx['user_ids'])}),
+}
+WRITE_SCENARIOS = {'like', 'comment', 'post', 'message_send'}
+SERVER_TIMING_DB = re.compile(r'db;[^,]*desc="?(\d+)')
+
+def percentile(values, q):
+    if not values: return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+class InProcessTarget:
+    """Приложение в том же процессе; SQL считается по потокам через события движка."""
+
+    def __init__(self):
+        from sqlalchemy import event, select
+        # Лог медленных запросов перемешивался бы с таблицей результатов
+        os.environ.setdefault('SLOW_REQUEST_MS', str(10 ** 9))
+        import server
+        self.server = server
+        self.local = threading.local()
+        with server.app.app_context():
+            event.listen(server.db.engine, 'before_cursor_execute', self._count)
+            users = server.db.session.execute(
+                select(server.User.id, server.User.handle, server.User.secret_code)
+                .where(server.User.secret_code.like(TOKEN_PREFIX + '%'))).all()
+            post_ids = server.db.session.scalars(select(server.Post.id)).all()
+            self.database = server.db.engine.url.render_as_string(hide_password=True)
+        self.context = {'user_ids': [u.id for u in users], 'handles': [u.handle for u in users],
+                        'tokens': [u.secret_code for u in users], 'post_ids': post_ids}
+
+    def _count(self, *args):
+        self.local.queries = getattr(self.local, 'queries', 0) + 1
+
+    def client(self):
+        return self.server.app.test_client()
+
+    def call(self, client, method, path, body, token):
+        self.local.queries = 0
+        response = client.open(path, method=method, json=body, headers={'Authorization': token})
+        response.close()
+        return response.status_code, self.local.queries, response.get_json(silent=True)
+
+class HttpTarget:
+    """Запущенный сервер; токены берутся по схеме bench/seed.py."""
+
+    def __init__(self, url, users):
+        import requests
+        self.requests = requests
+        self.url = url.rstrip('/')
+        tokens = [bench_token(i) for i in range(users)]
+        self.context = {'tokens': tokens, 'handles': [f"bench_{i}" for i in range(users)], 'user_ids': []}
+        session = requests.Session()
+        session.headers['Authorization'] = tokens[0]
+        posts = session.get(f"{self.url}/api/posts", params={'limit': 100}).json()['posts']
+        self.context['post_ids'] = [int(p['id']) for p in posts]
+        self.context['user_ids'] = list({p['author']['id'] for p in posts})
+
+    def client(self):
+        return self.requests.Session()
+
+    def call(self, client, method, path, body, token):
+        response = client.request(method, self.url + path, json=body, headers={'Authorization': token})
+        match = SERVER_TIMING_DB.search(response.headers.get('Server-Timing', ''))
+        try:
+            payload = response.json()
+        except ValueError:
+            payload = None
+        return response.status_code, int(match.group(1)) if match else None, payload
+
+def run_scenario(target, name, clients, total, seed):
+    ctx = target.context
+    ctx['users'] = len(ctx['tokens'])
+    if name == 'feed_page':
+        # Курсор из середины ленты, чтобы мерить именно keyset-страницу
+        status, _, body = target.call(target.client(), 'GET', '/api/posts?limit=100', None, ctx['tokens'][0])
+        ctx['cursor'] = (body or {}).get('nextCursor') or ''
+
+    per_client = max(1, total // clients)
+    lock = threading.Lock()
+    latencies, queries, statuses = [], [], {}
+
+    def worker(n):
+        rng = random.Random(seed * 1000 + n)
+        client = target.client()
+        token = ctx['tokens'][n % len(ctx['tokens'])]
+        local_lat, local_q, local_st = [], [], {}
+        for _ in range(per_client):
+            method, path, body = SCENARIOS[name](rng, ctx)
+            started = time.perf_counter()
+            status, count, _ = target.call(client, method, path, body, token)
+            local_lat.append((time.perf_counter() - started) * 1000)
+            if count is not None:
+                local_q.append(count)
+            local_st[status] = local_st.get(status, 0) + 1
+        with lock:
+            latencies.extend(local_lat)
+            queries.extend(local_q)
+            for status, n in local_st.items():
+                statuses[status] = statuses.get(status, 0) + n
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        list(pool.map(worker, range(clients)))
+    elapsed = time.perf_counter() - started
+
+    done = len(latencies)
+    return {
+        'requests': done,
+        'clients': clients,
+        'seconds': round(elapsed, 3),
+        'throughput_rps': round(done / elapsed, 1) if elapsed else None,
+        'latency_ms': {
+            'mean': round(sum(latencies) / done, 2) if done else None,
+            'p50': round(percentile(latencies, 50), 2) if done else None,
+            'p95': round(percentile(latencies, 95), 2) if done else None,
+            'p99': round(percentile(latencies, 99), 2) if done else None,
+            'max': round(max(latencies), 2) if done else None,
+        },
+        'sql_per_request': round(sum(queries) / len(queries), 2) if queries else None,
+        'sql_max': max(queries) if queries else None,
+        'statuses': {str(k): v for k, v in sorted(statuses.items())},
+        'errors': sum(n for s, n in statuses.items() if s >= 500),
+    }
+
+def compare(current, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)['scenarios']
+    print(f"\n{'scenario':<18}{'rps':>18}{'p95 ms':>20}{'sql/req':>16}")
+    for name, now in current.items():
+        was = baseline.get(name)
+        if not was: continue
+        cell = lambda a, b: f"{a} ({(b - a) / a * 100:+.0f}%)" if a and b is not None else f"{a} -> {b}"
+        print(f"{name:<18}{cell(was['throughput_rps'], now['throughput_rps']):>18}"
+              f"{cell(was['latency_ms']['p95'], now['latency_ms']['p95']):>20}"
+              f"{cell(was['sql_per_request'], now['sql_per_request']):>16}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help='адрес запущенного сервера; по умолчанию приложение в процессе')
+    parser.add_argument('--users', type=int, default=1000, help='число bench-пользователей (только для --url)')
+    parser.add_argument('--clients', type=int, default=8, help='параллельных клиентов')
+    parser.add_argument('--requests', type=int, default=400, help='запросов на сценарий')
+    parser.add_argument('--only', help='сценарии через запятую')
+    parser.add_argument('--writes', action='store_true', help='включить пишущие сценарии')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('-o', '--output', help='куда сохранить результаты в JSON')
+    parser.add_argument('--compare', help='JSON предыдущего прогона для сравнения')
+    args = parser.parse_args()
+
+    names = args.only.split(',') if args.only else [
+        n for n in SCENARIOS if args.writes or n not in WRITE_SCENARIOS]
+    unknown = set(names) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    target = HttpTarget(args.url, args.users) if args.url else InProcessTarget()
+    if not target.context['tokens']:
+        sys.exit('No bench users found, run bench/seed.py first')
+
+    results = {}
+    print(f"{'scenario':<18}{'rps':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'sql/req':>9}{'5xx':>6}")
+    for name in names:
+        r = results[name] = run_scenario(target, name, args.clients, args.requests, args.seed)
+        lat = r['latency_ms']
+        print(f"{name:<18}{r['throughput_rps']:>9}{lat['p50']:>9}{lat['p95']:>9}{lat['p99']:>9}"
+              f"{r['sql_per_request'] if r['sql_per_request'] is not None else '-':>9}{r['errors']:>6}")
+
+    if args.output:
+        report = {
+            'meta': {
+                'started_at': datetime.utcnow().isoformat() + 'Z',
+                'target': args.url or 'in-process',
+                'database': getattr(target, 'database', None),
+                'clients': args.clients,
+                'requests_per_scenario': args.requests,
+                'seed': args.seed,
+                'python': platform.python_version(),
+            },
+            'scenarios': results,
+        }
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"--- RESULTS SAVED TO {args.output} ---")
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+"""
+Генератор синтетического социального графа для нагрузочных тестов.
+
+    DATABASE_URL=sqlite:////tmp/bench.db python bench/seed.py --users 2000 --friends 20
+    DATABASE_URL=postgresql://... python bench/seed.py --users 20000 --posts 10 --seed 7
+
+Создает схему (create_all + миграции), затем пачками вставляет пользователей,
+дружбы, заявки, посты, лайки, комментарии, личные сообщения и треки.
+Генерация детерминирована при одинаковом --seed. Счетчики пересчитываются
+в конце через reconcile_counters, затем заполняются ленты друзей. Токены
+пользователей имеют вид BENCH-000001, ..., их использует bench/run.py.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import insert, select, func  # noqa: E402
+from server import (app, db, run_migrations, reconcile_counters, backfill_timelines, friends_table,  # noqa: E402
+                    User, Post, PostLike, Comment, Message, FriendRequest, Track, TrackLike)
+
+BATCH_SIZE = 5000
+TOKEN_PREFIX = 'BENCH-'
+WORDS = ('neural', 'signal', 'node', 'sync', 'matrix', 'pulse', 'vector', 'echo', 'grid', 'flux',
+         'кибер', 'сеть', 'поток', 'ядро', 'синхрон', 'импульс', 'код', 'узел', 'данные', 'свет')
+
+def bench_token(i):
+    return f"{TOKEN_PREFIX}{i:06d}"
+
+def sentence(rng, lo=3, hi=15):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(lo, hi)))
+
+def insert_rows(target, rows):
+    for i in range(0, len(rows), BATCH_SIZE):
+        db.session.execute(insert(target), rows[i:i + BATCH_SIZE])
+    db.session.commit()
+
+def pick_pairs(rng, user_ids, per_user):
+    """Неориентированные пары без петель и повторов, в среднем per_user соседей на узел."""
+    target = len(user_ids) * per_user // 2
+    pairs = set()
+    attempts = 0
+    while len(pairs) < target and attempts < target * 10:
+        attempts += 1
+        a, b = rng.sample(user_ids, 2)
+        pairs.add((a, b) if a < b else (b, a))
+    return sorted(pairs)
+
+def seed(args):
+    rng = random.Random(args.seed)
+    now = datetime.utcnow()
+    span = timedelta(days=args.days).total_seconds()
+    ts = lambda: now - timedelta(seconds=rng.uniform(0, span))
+    stats = {}
+
+    start = db.session.scalar(select(func.count()).select_from(User)) or 0
+    users = [{
+        'id': f"00000000-0000-4000-8000-{start + i:012d}",
+        'name': f"bench_{start + i}",
+        'handle': f"bench_{start + i}",
+        'secret_code': bench_token(start + i),
+        'avatar': f"https://i.pravatar.cc/150?img={rng.randint(1, 70)}",
+        'bio': sentence(rng, 2, 6),
+        'status': '',
+        'is_verified': rng.random() < 0.05,
+        'is_admin': False,
+        'last_seen': ts(),
+        'created_at': ts(),
+    } for i in range(args.users)]
+    insert_rows(User, users)
+    user_ids = [u['id'] for u in users]
+    stats['users'] = len(users)
+
+    pairs = pick_pairs(rng, user_ids, args.friends)
+    insert_rows(friends_table, [{'user_id': a, 'friend_id': b} for a, b in pairs] +
+                               [{'user_id': b, 'friend_id': a} for a, b in pairs])
+    stats['friendships'] = len(pairs)
+
+    linked = set(pairs)
+    requests_ = []
+    for a, b in pick_pairs(rng, user_ids, args.requests):
+        if (a, b) in linked: continue
+        sender, receiver = (a, b) if rng.random() < 0.5 else (b, a)
+        requests_.append({'sender_id': sender, 'receiver_id': receiver, 'timestamp': ts()})
+    insert_rows(FriendRequest, requests_)
+    stats['friend_requests'] = len(requests_)
+
+    posts = [{'user_id': rng.choice(user_ids), 'content': sentence(rng), 'timestamp': ts(),
+              'image_url': None} for _ in range(args.users * args.posts)]
+    insert_rows(Post, posts)
+    post_ids = db.session.scalars(select(Post.id).order_by(Post.id.desc()).limit(len(posts))).all()
+    stats['posts'] = len(posts)
+
+    # Лайки распределены неравномерно: популярные посты получают большую часть
+    likes, seen = [], set()
+    for _ in range(len(post_ids) * args.likes):
+        pair = (post_ids[int(len(post_ids) * rng.random() ** 3)], rng.choice(user_ids))
+        if pair in seen: continue
+        seen.add(pair)
+        likes.append({'post_id': pair[0], 'user_id': pair[1], 'timestamp': ts()})
+    insert_rows(PostLike, likes)
+    stats['likes'] = len(likes)
+
+    comments = [{'post_id': rng.choice(post_ids), 'user_id': rng.choice(user_ids),
+                 'content': sentence(rng, 2, 10), 'timestamp': ts()} for _ in range(len(post_ids) * args.comments)]
+    insert_rows(Comment, comments)
+    stats['comments'] = len(comments)
+
+    messages = []
+    for _ in range(args.users * args.messages):
+        a, b = pairs[rng.randrange(len(pairs))] if pairs else rng.sample(user_ids, 2)
+        sender, recipient = (a, b) if rng.random() < 0.5 else (b, a)
+        messages.append({'sender_id': sender, 'recipient_id': recipient, 'text': sentence(rng, 1, 12),
+                         'timestamp': ts(), 'conversation_key': Message.key_for(sender, recipient)})
+    for _ in range(args.public_messages):
+        messages.append({'sender_id': rng.choice(user_ids), 'recipient_id': None, 'text': sentence(rng, 1, 12),
+                         'timestamp': ts(), 'conversation_key': Message.PUBLIC_KEY})
+    messages.sort(key=lambda m: m['timestamp'])
+    insert_rows(Message, messages)
+    stats['messages'] = len(messages)
+
+    tracks = [{'title': sentence(rng, 1, 3), 'artist': sentence(rng, 1, 2), 'genre': rng.choice(WORDS),
+               'url': f"https://example.com/stream/{i}.mp3", 'added_by': rng.choice(user_ids)}
+              for i in range(args.tracks)]
+    insert_rows(Track, tracks)
+    track_ids = db.session.scalars(select(Track.id)).all()
+    track_likes = {(rng.choice(user_ids), rng.choice(track_ids)) for _ in range(args.tracks * args.track_likes)}
+    insert_rows(TrackLike, [{'user_id': u, 'track_id': t} for u, t in sorted(track_likes)])
+    stats['tracks'] = len(tracks)
+    stats['track_likes'] = len(track_likes)
+
+    reconcile_counters()
+    backfill_timelines()
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--friends', type=int, default=20, help='среднее число друзей на пользователя')
+    parser.add_argument('--requests', type=int, default=2, help='среднее число входящих/исходящих заявок')
+    parser.add_argument('--posts', type=int, default=5, help='постов на пользователя')
+    parser.add_argument('--likes', type=int, default=5, help='лайков на пост')
+    parser.add_argument('--comments', type=int, default=2, help='комментариев на пост')
+    parser.add_argument('--messages', type=int, default=10, help='личных сообщений на пользователя')
+    parser.add_argument('--public-messages', type=int, default=500)
+    parser.add_argument('--tracks', type=int, default=50)
+    parser.add_argument('--track-likes', type=int, default=10, help='лайков на трек')
+    parser.add_argument('--days', type=int, default=60, help='глубина истории')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    with app.app_context():
+        db.create_all()
+        run_migrations()
+        stats = seed(args)
+    print(f"--- SEEDED {app.config['SQLALCHEMY_DATABASE_URI'].split('@')[-1]} "
+          f"in {time.perf_counter() - started:.1f}s ---")
+    for name, n in stats.items():
+        print(f"{name:>16}: {n}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""
+Сравнение конкурентной записи в SQLite с настройкой PRAGMA и без нее.
+
+    python bench/sqlite_writes.py --clients 8 --requests 800 -o sqlite_writes.json
+
+Один раз заполняет базу через bench/seed.py (без PRAGMA, в режиме rollback
+journal), копирует ее и гоняет пишущие сценарии bench/run.py по каждой копии:
+SQLITE_PRAGMAS=0 (настройки SQLite по умолчанию) и SQLITE_PRAGMAS=1 (WAL,
+synchronous=NORMAL, busy_timeout, mmap, cache). Ошибки "database is locked"
+видны как 5xx в колонке ошибок.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCENARIOS = 'like,comment,post,message_send'
+
+def run(script, env, *args):
+    subprocess.run([sys.executable, os.path.join(HERE, script), *args], env={**os.environ, **env}, check=True)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=800, help='запросов на сценарий')
+    parser.add_argument('--scenarios', default=SCENARIOS)
+    parser.add_argument('-o', '--output', help='куда сохранить результаты обоих прогонов в JSON')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='neural-bench-')
+    try:
+        base = os.path.join(workdir, 'base.db')
+        run('seed.py', {'DATABASE_URL': 'sqlite:///' + base, 'SQLITE_PRAGMAS': '0'}, '--users', str(args.users))
+
+        reports = {}
+        for mode, pragmas in (('default', '0'), ('tuned', '1')):
+            path = os.path.join(workdir, f"{mode}.db")
+            shutil.copy(base, path)
+            out = os.path.join(workdir, f"{mode}.json")
+            print(f"\n--- {mode.upper()} (SQLITE_PRAGMAS={pragmas}) ---")
+            extra = ['--compare', os.path.join(workdir, 'default.json')] if mode == 'tuned' else []
+            run('run.py', {'DATABASE_URL': 'sqlite:///' + path, 'SQLITE_PRAGMAS': pragmas},
+                '--only', args.scenarios, '--clients', str(args.clients), '--requests', str(args.requests),
+                '-o', out, *extra)
+            with open(out) as f:
+                reports[mode] = json.load(f)
+
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(reports, f, indent=2, ensure_ascii=False)
+            print(f"--- RESULTS SAVED TO {args.output} ---")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
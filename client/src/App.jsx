@@ -130,6 +130,7 @@ const AppProvider = ({ children }) => {
   
   const [activeChat, setActiveChat] = useState(null);
   const lastMsgIdRef = useRef(null);
+  const requestsDigestRef = useRef(null);
 
   useEffect(() => {
     if (token) {
@@ -158,17 +159,22 @@ const AppProvider = ({ children }) => {
       if (!token || !user) return;
       const runPolling = async () => {
           try {
-              const msgRes = await axios.get(`${API_URL}/messages`, { headers: { Authorization: token } });
-              const msgs = msgRes.data;
-              if (msgs.length > 0) {
-                  const lastMsg = msgs[msgs.length - 1];
-                  if (lastMsgIdRef.current && lastMsg.id !== lastMsgIdRef.current && !lastMsg.isOwn && !activeChat) {
+              // Сервер отвечает 304, пока ничего не изменилось - браузер подставит закэшированную сводку
+              const pollRes = await axios.get(`${API_URL}/poll`, { headers: { Authorization: token } });
+              const digest = pollRes.data;
+              const lastMsg = digest.lastMessage;
+              if (lastMsg) {
+                  if (lastMsgIdRef.current && lastMsg.id !== lastMsgIdRef.current && !activeChat) {
                       setNotification(`Сообщение от ${lastMsg.senderName}: ${lastMsg.text.substring(0, 30)}...`);
                   }
                   lastMsgIdRef.current = lastMsg.id;
               }
-              const reqRes = await axios.get(`${API_URL}/friends/requests`, { headers: { Authorization: token } });
-              setFriendRequests(reqRes.data);
+              const requestsDigest = `${digest.pendingRequests}:${digest.lastRequestId}`;
+              if (requestsDigest !== requestsDigestRef.current) {
+                  requestsDigestRef.current = requestsDigest;
+                  const reqRes = await axios.get(`${API_URL}/friends/requests`, { headers: { Authorization: token } });
+                  setFriendRequests(reqRes.data.requests);
+              }
           } catch (e) { }
       };
       const interval = setInterval(runPolling, 3000); 
@@ -583,7 +589,7 @@ const FeedView = () => {
   const { token } = useApp();
   const [posts, setPosts] = useState([]);
   const [loading, setLoading] = useState(true);
-  const fetchPosts = async () => { try { const res = await axios.get(`${API_URL}/posts`, { headers: { Authorization: token || '' } }); setPosts(res.data); setLoading(false); } catch (e) { } };
+  const fetchPosts = async () => { try { const res = await axios.get(`${API_URL}/posts`, { headers: { Authorization: token || '' } }); setPosts(res.data.posts); setLoading(false); } catch (e) { } };
   useEffect(() => { fetchPosts(); const interval = setInterval(fetchPosts, 3000); return () => clearInterval(interval); }, [token]);
   const handleCreatePost = async (content, imageUrl) => { try { await axios.post(`${API_URL}/posts`, { content, imageUrl }, { headers: { Authorization: token || '' } }); fetchPosts(); } catch (e) { alert("Ошибка отправки сигнала"); } };
   const handleLikeUpdate = (postId, newLikes, isLiked) => { setPosts(prev => prev.map(p => p.id === postId ? { ...p, likes: newLikes, isLiked } : p)); };
@@ -615,11 +621,37 @@ const MessagesView = () => {
   const [input, setInput] = useState('');
   const [chatList, setChatList] = useState([]); 
   const chatEndRef = useRef(null);
-  useEffect(() => { axios.get(`${API_URL}/users/${user.handle.replace('@','')}`, {headers: {Authorization: token}}).then(res => setChatList(res.data.friendsList)).catch(e => console.error(e)); }, []);
-  const fetchMessages = async () => { try { const url = activeChat ? `${API_URL}/messages?partner_id=${activeChat.id}` : `${API_URL}/messages`; const res = await axios.get(url, { headers: { Authorization: token } }); setMessages(res.data); } catch (e) { } };
-  useEffect(() => { fetchMessages(); const interval = setInterval(fetchMessages, 2000); return () => clearInterval(interval); }, [activeChat]);
+  useEffect(() => { axios.get(`${API_URL}/users/${user.handle.replace('@','')}/friends`, {headers: {Authorization: token}, params: {limit: 100}}).then(res => setChatList(res.data.friends)).catch(e => console.error(e)); }, []);
+  const lastMsgIdRef = useRef(null);
+  useEffect(() => { lastMsgIdRef.current = messages.length ? messages[messages.length - 1].id : null; }, [messages]);
+  const fetchMessages = async (sinceId) => { try { const res = await axios.get(`${API_URL}/messages`, { headers: { Authorization: token }, params: { partner_id: activeChat ? activeChat.id : undefined, since_id: sinceId || undefined } }); setMessages(prev => sinceId ? [...prev, ...res.data.filter(m => !prev.some(p => p.id === m.id))] : res.data); } catch (e) { } };
+  const fetchNewMessages = () => fetchMessages(lastMsgIdRef.current);
+  useEffect(() => {
+      fetchMessages();
+      // Стрим открывается по короткоживущему билету; пока он недоступен - опрос раз в 3 секунды.
+      // Пока открыт - редкий опрос на случай событий, опубликованных в другом воркере
+      let stream = null, poller = null, retry = null, closed = false, lastEventId = null;
+      const setPolling = (ms) => { clearInterval(poller); poller = setInterval(fetchNewMessages, ms); };
+      const reconnect = () => { if (!closed) retry = setTimeout(open, 5000); };
+      const open = async () => {
+          try {
+              const res = await axios.post(`${API_URL}/stream/ticket`, {}, { headers: { Authorization: token } });
+              if (closed) return;
+              // Новый EventSource сам Last-Event-ID не шлет - передаем его, чтобы дочитать пропущенное
+              const resume = lastEventId ? `&lastEventId=${encodeURIComponent(lastEventId)}` : '';
+              stream = new EventSource(`${API_URL}/stream?ticket=${encodeURIComponent(res.data.ticket)}${resume}`);
+              stream.onopen = () => setPolling(15000);
+              stream.onerror = () => { setPolling(3000); if (stream.readyState === EventSource.CLOSED) reconnect(); };
+              const track = (handler) => (e) => { if (e.lastEventId) lastEventId = e.lastEventId; handler(); };
+              stream.addEventListener('message', track(fetchNewMessages));
+              ['message_deleted', 'reset'].forEach(ev => stream.addEventListener(ev, track(() => fetchMessages())));
+          } catch (e) { setPolling(3000); reconnect(); }
+      };
+      open();
+      return () => { closed = true; if (stream) stream.close(); clearInterval(poller); clearTimeout(retry); };
+  }, [activeChat]);
   useEffect(() => { chatEndRef.current?.scrollIntoView({ behavior: 'smooth' }); }, [messages.length, activeChat]);
-  const handleSend = async () => { if(!input.trim()) return; try { const payload = { text: input, recipientId: activeChat ? activeChat.id : null }; await axios.post(`${API_URL}/messages`, payload, { headers: { Authorization: token } }); setInput(''); fetchMessages(); } catch (e) { } }
+  const handleSend = async () => { if(!input.trim()) return; try { const payload = { text: input, recipientId: activeChat ? activeChat.id : null }; await axios.post(`${API_URL}/messages`, payload, { headers: { Authorization: token } }); setInput(''); fetchNewMessages(); } catch (e) { } }
   const handleDeleteMessage = async (msgId) => { if(!confirm("Удалить сообщение?")) return; try { await axios.delete(`${API_URL}/messages?id=${msgId}`, { headers: { Authorization: token } }); fetchMessages(); } catch(e) { } }
   return (
     <div className="h-[calc(100vh-140px)] md:h-[80vh] flex flex-col md:flex-row gap-6 animate-in fade-in duration-500 pb-2 md:pb-0">
@@ -677,10 +709,15 @@ const ProfileViewGeneric = ({ profileUser, isOwn }) => {
     const loadProfileData = async () => {
         if(!profileUser) return;
         try {
-            const res = await axios.get(`${API_URL}/users/${profileUser.handle}`, { headers: {Authorization: token || ''} });
+            const headers = { Authorization: token || '' };
+            const [res, postsRes, friendsRes] = await Promise.all([
+                axios.get(`${API_URL}/users/${profileUser.handle}`, { headers }),
+                axios.get(`${API_URL}/users/${profileUser.handle}/posts`, { headers }),
+                axios.get(`${API_URL}/users/${profileUser.handle}/friends`, { headers })
+            ]);
             const d = res.data;
-            setPosts(d.posts);
-            setFriends(d.friendsList);
+            setPosts(postsRes.data.posts);
+            setFriends(friendsRes.data.friends);
             setStatusData({ isFriend: d.friendStatus === 'friends', isPendingSent: d.friendStatus === 'pending_sent', isPendingReceived: d.friendStatus === 'pending_received', isAdmin: d.isAdmin, isVerified: d.isVerified, lastSeen: d.lastSeen, reputation: d.reputation, postsCount: d.postsCount });
             if(isOwn) { setEditBio(d.bio || ''); setEditAvatar(d.avatar || ''); setEditStatus(d.status || ''); }
         } catch (e) { console.error(e); }
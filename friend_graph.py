@@ -0,0 +1,132 @@
+"""
+Граф дружбы в памяти процесса.
+
+Строковые id пользователей отображаются в плотные целые, у каждого узла -
+отсортированный массив array('i') id друзей (4 байта на ребро в каждом
+направлении). Проверка дружбы - бинарный поиск, общие друзья - пересечение
+отсортированных массивов, рекомендации - подсчет друзей друзей.
+
+Модуль не знает о Flask и БД: загрузку из таблицы friends и синхронизацию
+между воркерами делает server.py. Запись идет под локом; чтение без
+блокировок - в худшем случае оно увидит граф на одно изменение старше.
+"""
+import bisect
+import threading
+from array import array
+from collections import Counter
+
+class FriendGraph:
+    def __init__(self):
+        self._index = {}   # id пользователя -> номер узла
+        self._ids = []     # номер узла -> id пользователя
+        self._adj = []     # номер узла -> отсортированный array('i') соседей
+        self._lock = threading.Lock()
+        self.edges = 0
+
+    def _node(self, user_id):
+        node = self._index.get(user_id)
+        if node is None:
+            # Сначала массивы, потом индекс: читатель без лока не должен найти
+            # номер узла, для которого еще нет списка соседей
+            node = len(self._ids)
+            self._ids.append(user_id)
+            self._adj.append(array('i'))
+            self._index[user_id] = node
+        return node
+
+    def _neighbors(self, user_id):
+        node = self._index.get(user_id)
+        return self._adj[node] if node is not None else array('i')
+
+    @classmethod
+    def from_edges(cls, pairs):
+        """
+        Граф из пар (user_id, friend_id) таблицы friends. Таблица хранит
+        дружбу в обе стороны, но граф симметризуется сам, так что хватит и
+        одной. Массивы заполняются как есть и сортируются один раз в конце.
+        """
+        graph = cls()
+        raw = graph._adj
+        for user_id, friend_id in pairs:
+            a, b = graph._node(user_id), graph._node(friend_id)
+            raw[a].append(b)
+            raw[b].append(a)
+        graph._adj = [array('i', sorted(set(neighbors))) for neighbors in raw]
+        graph.edges = sum(len(a) for a in graph._adj) // 2
+        return graph
+
+    def add(self, user_id, friend_id):
+        with self._lock:
+            a, b = self._node(user_id), self._node(friend_id)
+            if _insert(self._adj[a], b):
+                _insert(self._adj[b], a)
+                self.edges += 1
+
+    def remove(self, user_id, friend_id):
+        with self._lock:
+            a, b = self._index.get(user_id), self._index.get(friend_id)
+            if a is None or b is None: return
+            if _discard(self._adj[a], b):
+                _discard(self._adj[b], a)
+                self.edges -= 1
+
+    def are_friends(self, user_id, other_id):
+        other = self._index.get(other_id)
+        return other is not None and _contains(self._neighbors(user_id), other)
+
+    def degree(self, user_id):
+        return len(self._neighbors(user_id))
+
+    def friends(self, user_id):
+        return [self._ids[n] for n in self._neighbors(user_id)]
+
+    def mutual_friends(self, user_id, other_id):
+        small, large = sorted((self._neighbors(user_id), self._neighbors(other_id)), key=len)
+        if not small: return []
+        # Сильно разные степени: бинарный поиск каждого элемента меньшего массива,
+        # иначе линейный проход по большему с проверкой по множеству меньшего
+        if len(small) * max(1, len(large).bit_length()) < len(large):
+            common = [n for n in small if _contains(large, n)]
+        else:
+            members = set(small)
+            common = [n for n in large if n in members]
+        return [self._ids[n] for n in common]
+
+    def suggestions(self, user_id, limit=10, exclude=()):
+        """
+        [(id, число общих друзей), ...] по убыванию общих друзей: друзья
+        друзей, кроме самого пользователя, его друзей и exclude.
+        """
+        node = self._index.get(user_id)
+        if node is None: return []
+        direct = self._adj[node]
+        counts = Counter()
+        for friend in direct:
+            counts.update(self._adj[friend])
+        for n in direct:
+            counts.pop(n, None)
+        counts.pop(node, None)
+        for uid in exclude:
+            counts.pop(self._index.get(uid), None)
+        return [(self._ids[n], c) for n, c in counts.most_common(limit)]
+
+    def stats(self):
+        return {'users': len(self._ids), 'edges': self.edges,
+                'bytes': sum(a.itemsize * len(a) for a in self._adj)}
+
+def _contains(arr, value):
+    i = bisect.bisect_left(arr, value)
+    return i < len(arr) and arr[i] == value
+
+def _insert(arr, value):
+    i = bisect.bisect_left(arr, value)
+    if i < len(arr) and arr[i] == value: return False
+    arr.insert(i, value)
+    return True
+
+def _discard(arr, value):
+    i = bisect.bisect_left(arr, value)
+    if i < len(arr) and arr[i] == value:
+        del arr[i]
+        return True
+    return False
@@ -0,0 +1,25 @@
+# Конфиг gunicorn (подхватывается автоматически из рабочей директории):
+#     gunicorn server:app
+# /api/stream держит соединение открытым, поэтому воркеры потоковые:
+# у синхронного воркера одна открытая вкладка чата занимала бы его целиком.
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+# EventHub доставляет события только внутри процесса: сообщение, отправленное
+# через другой воркер, до стрима не дойдет (клиент подберет его редким опросом).
+# Поэтому по умолчанию один воркер, а масштабируемся потоками.
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+worker_class = 'gthread'
+# Каждое SSE-соединение занимает поток; остальные запросы идут в оставшихся
+threads = int(os.environ.get('GUNICORN_THREADS', 64))
+# SSE шлет ping раз в 15 секунд, так что живые стримы не попадают под таймаут
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 60))
+
+def on_starting(arbiter):
+    # Миграции один раз в мастере до запуска воркеров: без них обновленная база
+    # осталась бы без новых колонок и таблиц. Соединения мастера закрываем,
+    # чтобы воркеры после fork не делили их.
+    from server import app, db, prepare_database
+    prepare_database()
+    with app.app_context():
+        db.engine.dispose()
@@ -5,12 +5,30 @@ import os
 import random
 import string
 import uuid
+import atexit
+import hashlib
+import hmac
+import re
+import json
+import queue
+import bisect
+import glob
+import sqlite3
+import math
+import heapq
+from collections import OrderedDict, namedtuple, deque
 from datetime import datetime, timedelta
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, g, has_request_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-from sqlalchemy import func, or_, and_
+from sqlalchemy import event, func, or_, and_, bindparam, case, column, delete, inspect, literal, literal_column, select, table, text, true, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import Pool
+from sqlalchemy.orm import joinedload
+from sqlalchemy.schema import CreateIndex
 from werkzeug.security import generate_password_hash, check_password_hash
+from friend_graph import FriendGraph
 
 # --- КОНФИГУРАЦИЯ ---
 app = Flask(__name__)
@@ -28,8 +46,41 @@ if database_url and database_url.startswith("postgres://"):
 app.config['SQLALCHEMY_DATABASE_URI'] = database_url or 'sqlite:///' + os.path.join(basedir, 'neural.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+# Пул соединений Postgres. pre_ping отсеивает соединения, закрытые сервером
+# или балансировщиком, recycle не дает держать соединение дольше их таймаутов
+if not app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        'pool_timeout': float(os.environ.get('DB_POOL_TIMEOUT', 30)),
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': os.environ.get('DB_POOL_PRE_PING', '1') == '1',
+    }
+
+# PRAGMA для каждого нового соединения SQLite. WAL позволяет читать во время
+# записи, synchronous=NORMAL в WAL-режиме не делает fsync на каждый коммит
+# (коммит не теряет целостность, но может пропасть при отключении питания),
+# busy_timeout заставляет писателя ждать лок вместо "database is locked".
+# SQLITE_PRAGMAS=0 выключает настройку (для сравнения в bench/sqlite_writes.py).
+SQLITE_PRAGMAS = {
+    'journal_mode': os.environ.get('SQLITE_JOURNAL_MODE', 'WAL'),
+    'synchronous': os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL'),
+    'busy_timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000)),
+    'mmap_size': int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),
+    # Отрицательное значение - размер в KiB, а не в страницах
+    'cache_size': -int(os.environ.get('SQLITE_CACHE_SIZE_KB', 64 * 1024)),
+} if os.environ.get('SQLITE_PRAGMAS', '1') == '1' else {}
+
 db = SQLAlchemy(app)
 
+@event.listens_for(Engine, 'connect')
+def configure_sqlite_connection(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection): return
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {name}={value}")
+    cursor.close()
+
 # --- МОДЕЛИ ---
 
 friends_table = db.Table('friends',
@@ -43,12 +94,31 @@ class FriendRequest(db.Model):
     receiver_id = db.Column(db.String(36), db.ForeignKey('user.id'), nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        # (receiver_id, id): входящие заявки - range scan в порядке id, COUNT - только по индексу
+        db.Index('ix_friend_request_receiver', 'receiver_id', 'id'),
+        db.Index('uq_friend_request_pair', 'sender_id', 'receiver_id', unique=True),
+    )
+
+class FriendEdgeEvent(db.Model):
+    """Журнал изменений таблицы friends: по нему воркеры догоняют свой FriendGraph."""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.String(36), nullable=False)
+    friend_id = db.Column(db.String(36), nullable=False)
+    added = db.Column(db.Boolean, nullable=False)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
 class PostLike(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.String(36), db.ForeignKey('user.id'), nullable=False)
     post_id = db.Column(db.Integer, db.ForeignKey('post.id'), nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        db.Index('uq_post_like_post_user', 'post_id', 'user_id', unique=True),
+        db.Index('ix_post_like_user_timestamp', 'user_id', 'timestamp'),
+    )
+
 class User(db.Model):
     id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
     name = db.Column(db.String(50), unique=True, nullable=False)
@@ -63,6 +133,13 @@ class User(db.Model):
     last_seen = db.Column(db.DateTime, default=datetime.utcnow)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    # Денормализованные счетчики, обновляются в тех же транзакциях, что и данные
+    reputation = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    posts_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    friends_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    # Правки профиля (имя, аватар, био, статус, флаги) - часть версии закэшированной карточки
+    profile_version = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+
     friends = db.relationship(
         'User', secondary=friends_table,
         primaryjoin=(friends_table.c.user_id == id),
@@ -77,26 +154,14 @@ class User(db.Model):
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
 
-    def get_reputation(self):
-        total = 0
-        posts = Post.query.filter_by(user_id=self.id).all()
-        for p in posts:
-            total += p.likes_relations.count()
-        return total
-
-    def get_posts_count(self):
-        return Post.query.filter_by(user_id=self.id).count()
-
     def to_dict(self, current_user=None):
         friend_status = 'none'
-        if current_user and current_user.id != self.id:
-            if current_user.friends.filter_by(id=self.id).first():
-                friend_status = 'friends'
-            elif FriendRequest.query.filter_by(sender_id=current_user.id, receiver_id=self.id).first():
-                friend_status = 'pending_sent'
-            elif FriendRequest.query.filter_by(sender_id=self.id, receiver_id=current_user.id).first():
-                friend_status = 'pending_received'
+        if current_user:
+            friend_status = friend_statuses(current_user.id, [self.id])[self.id]
+        return User.assemble(self.public_dict(), friend_status)
 
+    def public_dict(self):
+        """Часть карточки, не зависящая от зрителя - ее и кэширует fragment_cache."""
         return {
             'id': self.id,
             'name': self.name,
@@ -104,22 +169,52 @@ class User(db.Model):
             'avatar': self.avatar,
             'bio': self.bio,
             'status': self.status,
-            'reputation': self.get_reputation(),
-            'postsCount': self.get_posts_count(),
+            'reputation': self.reputation,
+            'postsCount': self.posts_count,
             'isVerified': self.is_verified,
             'isAdmin': self.is_admin,
             'lastSeen': self.last_seen.isoformat() if self.last_seen else None,
-            'friendStatus': friend_status,
-            'friendsCount': self.friends.count()
+            'friendsCount': self.friends_count
         }
 
+    @property
+    def fragment_key(self):
+        # Как у Post: счетчики плюс profile_version, новый ключ - при любой правке карточки
+        return ('user', *(getattr(self, c.key) for c in USER_FRAGMENT_STATE))
+
+    @staticmethod
+    def assemble(public, friend_status='none'):
+        # lastSeen из буфера присутствия обычно свежее закэшированной копии колонки,
+        # но фрагмент мог собраться уже после сброса отметки другим воркером
+        last_seen = presence.get(public['id'])
+        result = {**public, 'friendStatus': friend_status}
+        if last_seen and (not public['lastSeen'] or last_seen.isoformat() > public['lastSeen']):
+            result['lastSeen'] = last_seen.isoformat()
+        return result
+
+# Колонки, из которых складывается User.fragment_key
+USER_FRAGMENT_STATE = (User.id, User.reputation, User.posts_count, User.friends_count, User.profile_version)
+
+# Префиксный поиск по имени и хэндлу - range scan по выражению lower(...)
+db.Index('ix_user_name_lower', func.lower(User.name))
+db.Index('ix_user_handle_lower', func.lower(User.handle))
+
 class Post(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.String(36), db.ForeignKey('user.id'), nullable=False)
     content = db.Column(db.Text, nullable=False)
     image_url = db.Column(db.String(500), nullable=True)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    likes_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    comments_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    # Сумма весов событий, приведенных ко времени создания поста (см. TrendingBoard)
+    trending_score = db.Column(db.Float, default=0, server_default='0', nullable=False)
     
+    __table_args__ = (
+        db.Index('ix_post_timestamp_id', 'timestamp', 'id'),
+        db.Index('ix_post_user_timestamp_id', 'user_id', 'timestamp', 'id'),
+    )
+
     author = db.relationship('User', backref='posts')
     likes_relations = db.relationship('PostLike', backref='post', lazy='dynamic', cascade="all, delete-orphan")
     comments = db.relationship('Comment', backref='post', lazy=True, cascade="all, delete-orphan")
@@ -129,31 +224,76 @@ class Post(db.Model):
         if current_user_id:
             is_liked = self.likes_relations.filter_by(user_id=current_user_id).first() is not None
 
+        comments = self.comments
         return {
-            'id': str(self.id),
+            **self.public_dict([c.public_dict() for c in comments]),
             'author': self.author.to_dict(),
+            'isLiked': is_liked,
+            'comments': [c.to_dict() for c in comments]
+        }
+
+    def public_dict(self, comments):
+        """
+        Не зависящая от зрителя часть поста. Комментарии хранятся без данных
+        авторов (только userId) - их подставляет serialize_posts.
+        """
+        return {
+            'id': str(self.id),
             'content': self.content,
             'imageUrl': self.image_url,
             'timestamp': self.timestamp.strftime("%H:%M • %d.%m"),
-            'likes': self.likes_relations.count(),
-            'isLiked': is_liked,
-            'comments': [c.to_dict() for c in self.comments]
+            'likes': self.likes_count,
+            'comments': comments
         }
 
+    @property
+    def fragment_key(self):
+        # Версия поста - его счетчики: новый лайк или комментарий дает новый ключ
+        return ('post', self.id, self.likes_count, self.comments_count)
+
+class TimelineEntry(db.Model):
+    """
+    Материализованная лента друзей: строка на каждый пост в ленте каждого
+    получателя. timestamp копируется из поста, чтобы страница ленты была
+    range scan по (user_id, timestamp, post_id) без сортировки.
+    """
+    __tablename__ = 'timeline'
+    user_id = db.Column(db.String(36), primary_key=True)
+    post_id = db.Column(db.Integer, primary_key=True)
+    author_id = db.Column(db.String(36), nullable=False)
+    timestamp = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_timeline_user_timestamp_post', 'user_id', 'timestamp', 'post_id'),
+    )
+
 class Comment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     content = db.Column(db.String(200), nullable=False)
     user_id = db.Column(db.String(36), db.ForeignKey('user.id'), nullable=False)
     post_id = db.Column(db.Integer, db.ForeignKey('post.id'), nullable=False)
+    # Нужен для трендов; у комментариев до миграции 16 - NULL
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     user = db.relationship('User')
 
+    __table_args__ = (
+        db.Index('ix_comment_post_id', 'post_id'),
+    )
+
     def to_dict(self):
+        return Comment.assemble(self.public_dict(), self.user.public_dict())
+
+    def public_dict(self):
+        return {'id': self.id, 'content': self.content, 'userId': self.user_id}
+
+    @staticmethod
+    def assemble(public, author):
         return {
-            'id': self.id,
-            'content': self.content,
-            'author': self.user.name,
-            'handle': self.user.handle,
-            'avatar': self.user.avatar
+            'id': public['id'],
+            'content': public['content'],
+            'author': author['name'],
+            'handle': author['handle'],
+            'avatar': author['avatar']
         }
 
 class Message(db.Model):
@@ -162,10 +302,24 @@ class Message(db.Model):
     recipient_id = db.Column(db.String(36), db.ForeignKey('user.id'), nullable=True) 
     text = db.Column(db.String(500), nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    # 'public' для общего канала, '<меньший id>:<больший id>' для личного диалога
+    conversation_key = db.Column(db.String(80), nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_message_conversation_id', 'conversation_key', 'id'),
+        db.Index('ix_message_recipient_timestamp', 'recipient_id', 'timestamp'),
+    )
     
     sender = db.relationship('User', foreign_keys=[sender_id])
     recipient = db.relationship('User', foreign_keys=[recipient_id])
 
+    PUBLIC_KEY = 'public'
+
+    @staticmethod
+    def key_for(user_id, partner_id=None):
+        if not partner_id: return Message.PUBLIC_KEY
+        return ':'.join(sorted((user_id, partner_id)))
+
     def to_dict(self, current_user_id):
         return {
             'id': str(self.id),
@@ -177,12 +331,26 @@ class Message(db.Model):
             'isOwn': self.sender_id == current_user_id
         }
 
+class CollectionVersion(db.Model):
+    """
+    Счетчик версий коллекции ('posts', 'music', 'profiles'). Увеличивается
+    в транзакции каждой записи и служит основой ETag для GET-ответов.
+    """
+    name = db.Column(db.String(32), primary_key=True)
+    version = db.Column(db.Integer, default=0, nullable=False)
+
+    NAMES = ('posts', 'music', 'profiles')
+
 # --- МУЗЫКА И ИЗБРАННОЕ ---
 class TrackLike(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.String(36), db.ForeignKey('user.id'), nullable=False)
     track_id = db.Column(db.Integer, db.ForeignKey('track.id'), nullable=False)
 
+    __table_args__ = (
+        db.Index('uq_track_like_user_track', 'user_id', 'track_id', unique=True),
+    )
+
 class Track(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(100), nullable=False)
@@ -191,6 +359,7 @@ class Track(db.Model):
     cover = db.Column(db.String(500), default="https://images.unsplash.com/photo-1470225620780-dba8ba36b745?w=300&h=300&fit=crop")
     genre = db.Column(db.String(50), default="User Added")
     added_by = db.Column(db.String(36), db.ForeignKey('user.id'), nullable=True)
+    likes_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
     
     likes = db.relationship('TrackLike', backref='track', lazy='dynamic', cascade="all, delete-orphan")
 
@@ -206,24 +375,815 @@ class Track(db.Model):
             'url': self.url,
             'cover': self.cover,
             'genre': self.genre,
+            'likes': self.likes_count,
             'isLiked': is_liked
         }
 
-# --- MIDDLEWARE (LAST SEEN) ---
-@app.before_request
-def update_last_seen():
-    token = request.headers.get('Authorization')
-    if token:
+# --- КЭШ АВТОРИЗАЦИИ ---
+class TTLCache:
+    """Потокобезопасный LRU-кэш с ограниченным размером и временем жизни записей."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[1] < time.monotonic():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hitRatio': round(self.hits / total, 4) if total else 0.0
+            }
+
+# Все, что нужно обработчикам до загрузки полной модели User
+AuthUser = namedtuple('AuthUser', ['id', 'name', 'handle', 'avatar', 'is_admin', 'is_verified'])
+
+token_cache = TTLCache(
+    maxsize=int(os.environ.get('TOKEN_CACHE_SIZE', 10000)),
+    ttl=float(os.environ.get('TOKEN_CACHE_TTL', 300))
+)
+
+# Общие для всех зрителей фрагменты версионируются состоянием самой строки:
+# ('post', id, likes, comments) и ('user', id, счетчики, profile_version).
+# Сброс кэша в одном воркере не виден остальным, поэтому явной инвалидации нет
+fragment_cache = TTLCache(
+    maxsize=int(os.environ.get('FRAGMENT_CACHE_SIZE', 50000)),
+    ttl=float(os.environ.get('FRAGMENT_CACHE_TTL', 30))
+)
+
+def get_auth_user():
+    """
+    secret_code из заголовка Authorization -> AuthUser. Повторные запросы
+    с тем же токеном обслуживаются из token_cache без обращения к БД.
+    """
+    if 'auth_user' in g: return g.auth_user
+    g.auth_user = resolve_token(request.headers.get('Authorization'))
+    return g.auth_user
+
+def resolve_token(token):
+    if not token: return None
+    auth = token_cache.get(token)
+    if auth is None:
         user = User.query.filter_by(secret_code=token).first()
         if user:
-            user.last_seen = datetime.utcnow()
-            db.session.commit()
+            auth = AuthUser(user.id, user.name, user.handle, user.avatar, user.is_admin, user.is_verified)
+            token_cache.set(token, auth)
+    return auth
+
+def invalidate_auth(user):
+    token_cache.pop(user.secret_code)
+
+# Билет для /api/stream: EventSource не умеет слать заголовки, а secret_code
+# в URL попал бы в логи доступа и прокси. Билет живет STREAM_TICKET_TTL секунд
+# и подписан secret_code владельца, поэтому не нужен общий ключ между воркерами,
+# а смена кода сразу отзывает выданные билеты.
+STREAM_TICKET_TTL = int(os.environ.get('STREAM_TICKET_TTL', 60))
+
+def stream_ticket_signature(secret_code, payload):
+    return hmac.new(secret_code.encode(), payload.encode(), hashlib.sha256).hexdigest()[:32]
+
+def issue_stream_ticket(user_id, secret_code):
+    payload = f"{user_id}.{int(time.time()) + STREAM_TICKET_TTL}"
+    return f"{payload}.{stream_ticket_signature(secret_code, payload)}"
+
+def resolve_stream_ticket(ticket):
+    try:
+        user_id, expires, signature = (ticket or '').split('.')
+        if int(expires) < time.time(): return None
+    except ValueError:
+        return None
+    secret_code = db.session.scalar(select(User.secret_code).where(User.id == user_id))
+    if not secret_code or not hmac.compare_digest(signature, stream_ticket_signature(secret_code, f"{user_id}.{expires}")):
+        return None
+    return resolve_token(secret_code)
+
+# --- ПРИСУТСТВИЕ (LAST SEEN) ---
+class PresenceBuffer:
+    """
+    Write-behind буфер last_seen: запросы только отмечают время в памяти,
+    фоновый поток раз в interval секунд сбрасывает все отметки одним
+    пакетным UPDATE. Последний сброс выполняется при остановке процесса.
+    Сброшенные отметки еще retain секунд отдаются из get: закэшированные
+    до сброса карточки хранят более старое значение колонки.
+    """
+
+    def __init__(self, interval, retain=0):
+        self.interval = interval
+        self.retain = retain
+        self._pending = {}
+        self._flushed = {}  # user_id -> (last_seen, до какого time.monotonic() хранить)
+        self._lock = threading.Lock()
+        self._thread = None
+        self.last_flush = None
+        self.failures = 0
+
+    def touch(self, user_id):
+        with self._lock:
+            self._pending[user_id] = datetime.utcnow()
+            if self._thread is None:
+                # Стартуем лениво: под gunicorn поток должен жить в воркере, а не в мастере
+                self._thread = threading.Thread(target=self._run, name='presence-flush', daemon=True)
+                self._thread.start()
+                background_threads['presence-flush'] = self._thread
+                atexit.register(self.flush)
+
+    def get(self, user_id):
+        with self._lock:
+            last_seen = self._pending.get(user_id)
+            if last_seen is None:
+                last_seen, until = self._flushed.get(user_id, (None, 0))
+                if until < time.monotonic(): return None
+            return last_seen
+
+    def flush(self):
+        with self._lock:
+            if not self._pending:
+                self.last_flush = time.time()
+                return 0
+            batch = self._pending
+            self._pending = {}
+            # Отметки остаются видны и пока идет UPDATE
+            now = time.monotonic()
+            self._flushed = {uid: item for uid, item in self._flushed.items() if item[1] >= now}
+            self._flushed.update((uid, (ts, now + self.retain)) for uid, ts in batch.items())
+        try:
+            with app.app_context():
+                # Core executemany без проверки rowcount: ORM-вариант по PK падает
+                # StaleDataError на удаленном пользователе, и сброс не прошел бы никогда
+                users = User.__table__
+                db.session.execute(update(users).where(users.c.id == bindparam('uid')).values(last_seen=bindparam('ts')),
+                                   [{'uid': uid, 'ts': ts} for uid, ts in batch.items()])
+                db.session.commit()
+        except Exception as e:
+            print(f"Presence flush failed: {e}")
+            self.failures += 1
+            with self._lock:
+                # Возвращаем отметки, не затирая более свежие
+                for uid, ts in batch.items():
+                    self._pending.setdefault(uid, ts)
+            return 0
+        self.last_flush = time.time()
+        return len(batch)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+# Долгоживущие фоновые потоки процесса по имени; /api/metrics следит, что они живы
+background_threads = {}
+
+presence = PresenceBuffer(interval=float(os.environ.get('PRESENCE_FLUSH_INTERVAL', 15)), retain=fragment_cache.ttl)
+
+# --- ИНСТРУМЕНТАЦИЯ SQL ---
+# Каждый запрос получает Server-Timing: db (время и число SQL), app (полное
+# время обработчика) и dup, если одно и то же выражение выполнялось
+# SQL_REPEAT_THRESHOLD и более раз. При SQL_DEBUG=1 и ?_debug=sql в JSON-ответ
+# добавляется блок _debug. Запросы дольше SLOW_REQUEST_MS пишутся в лог
+# вместе с самыми дорогими выражениями.
+SQL_REPEAT_THRESHOLD = int(os.environ.get('SQL_REPEAT_THRESHOLD', 3))
+SLOW_REQUEST_MS = float(os.environ.get('SLOW_REQUEST_MS', 500))
+SQL_DEBUG = os.environ.get('SQL_DEBUG') == '1'
+
+class QueryStats:
+    """
+    SQL одного HTTP-запроса: число выражений, суммарное время и разбивка
+    по тексту выражения. Один текст с разными параметрами, выполненный
+    много раз подряд, - характерный признак N+1.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.count = 0
+        self.seconds = 0.0
+        self.statements = {}  # текст -> [count, seconds]
+
+    def record(self, statement, seconds, count=1):
+        self.count += count
+        self.seconds += seconds
+        entry = self.statements.setdefault(statement, [0, 0.0])
+        entry[0] += count
+        entry[1] += seconds
+
+    def merge(self, other):
+        for statement, (count, seconds) in other.statements.items():
+            self.record(statement, seconds, count)
+
+    def elapsed_ms(self):
+        return (time.perf_counter() - self.started) * 1000
+
+    def repeated(self):
+        rows = [(s, n, t) for s, (n, t) in self.statements.items() if n >= SQL_REPEAT_THRESHOLD]
+        return sorted(rows, key=lambda r: r[1], reverse=True)
+
+    def top(self, limit=5):
+        rows = [(s, n, t) for s, (n, t) in self.statements.items()]
+        return sorted(rows, key=lambda r: r[2], reverse=True)[:limit]
+
+    def to_dict(self):
+        describe = lambda rows: [{'sql': short_sql(s), 'count': n, 'ms': round(t * 1000, 2)} for s, n, t in rows]
+        return {
+            'queries': self.count,
+            'dbMs': round(self.seconds * 1000, 2),
+            'totalMs': round(self.elapsed_ms(), 2),
+            'repeated': describe(self.repeated()),
+            'top': describe(self.top()),
+        }
+
+def short_sql(statement, limit=200):
+    statement = ' '.join(statement.split())
+    return statement if len(statement) <= limit else statement[:limit] + '...'
+
+def sql_stats():
+    stats = request.environ.get('neural.sql_stats')
+    if stats is None:
+        stats = request.environ['neural.sql_stats'] = QueryStats()
+    return stats
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def sql_query_started(conn, cursor, statement, parameters, context, executemany):
+    conn.info['query_started'] = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def sql_query_finished(conn, cursor, statement, parameters, context, executemany):
+    # Фоновые потоки (presence, keep-alive) работают вне запроса и не учитываются
+    if has_request_context():
+        sql_stats().record(statement, time.perf_counter() - conn.info.pop('query_started'))
+
+@app.before_request
+def start_request_timer():
+    sql_stats()
+    request.environ['neural.in_flight'] = True
+    metrics.inc('neural_http_requests_in_flight')
+    metrics.ensure_writer()
+
+@app.after_request
+def report_sql_stats(response):
+    stats = sql_stats()
+    total_ms = stats.elapsed_ms()
+    repeated = stats.repeated()
+    timing = [f'db;dur={stats.seconds * 1000:.1f};desc="{stats.count} queries"', f'app;dur={total_ms:.1f}']
+    if repeated:
+        timing.append(f'dup;desc="{len(repeated)} repeated statements"')
+    response.headers['Server-Timing'] = ', '.join(timing)
+
+    if total_ms >= SLOW_REQUEST_MS:
+        lines = [f"SLOW REQUEST {request.method} {request.full_path.rstrip('?')} -> {response.status_code}: "
+                 f"{total_ms:.0f}ms, {stats.count} queries in {stats.seconds * 1000:.0f}ms"]
+        for statement, n, seconds in stats.top():
+            flag = ' N+1?' if n >= SQL_REPEAT_THRESHOLD else ''
+            lines.append(f"    {n:>4}x {seconds * 1000:8.1f}ms{flag}  {short_sql(statement)}")
+        print('\n'.join(lines))
+
+    if SQL_DEBUG and request.args.get('_debug') == 'sql' and response.is_json and not response.is_streamed:
+        body = response.get_json()
+        if isinstance(body, dict):
+            body['_debug'] = stats.to_dict()
+            response.set_data(app.json.dumps(body))
+    return response
+
+# --- МЕТРИКИ ---
+# /api/metrics отдает метрики в текстовом формате Prometheus. Под gunicorn
+# у каждого воркера свои счетчики: если задан METRICS_DIR (общий для всех
+# воркеров каталог), каждый воркер раз в METRICS_FLUSH_INTERVAL секунд
+# сохраняет туда свой снимок, а эндпоинт суммирует снимки всех воркеров.
+# Счетчики завершившихся воркеров продолжают учитываться, их gauge - нет.
+METRICS_DIR = os.environ.get('METRICS_DIR')
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+# имя -> (тип, описание)
+METRIC_TYPES = {
+    'neural_http_requests_total': ('counter', 'HTTP requests by route, method and status.'),
+    'neural_http_request_duration_seconds': ('histogram', 'HTTP request latency by route and method.'),
+    'neural_http_requests_in_flight': ('gauge', 'Requests currently being handled.'),
+    'neural_db_queries_total': ('counter', 'SQL statements executed by route.'),
+    'neural_db_pool_checkouts_total': ('counter', 'Connections checked out from the pool.'),
+    'neural_db_pool_size': ('gauge', 'Configured pool size.'),
+    'neural_db_pool_checked_out': ('gauge', 'Connections currently checked out.'),
+    'neural_db_pool_overflow': ('gauge', 'Connections open beyond pool size (negative: unused capacity).'),
+    'neural_cache_hits_total': ('counter', 'Cache hits.'),
+    'neural_cache_misses_total': ('counter', 'Cache misses.'),
+    'neural_cache_entries': ('gauge', 'Entries currently cached.'),
+    'neural_cache_hit_ratio': ('gauge', 'Cache hits / lookups since start.'),
+    'neural_sse_subscribers': ('gauge', 'Open /api/stream connections.'),
+    'neural_presence_pending': ('gauge', 'last_seen updates waiting for flush.'),
+    'neural_presence_last_flush_timestamp_seconds': ('gauge', 'Unix time of the last successful presence flush.'),
+    'neural_presence_flush_failures_total': ('counter', 'Failed presence flushes.'),
+    'neural_background_thread_alive': ('gauge', 'Whether a background thread is running (1) or dead (0).'),
+}
+
+class Metrics:
+    """
+    Счетчики и гистограммы процесса. Запись не берет блокировок: каждый
+    поток пишет в свой шард (threading.local), а snapshot суммирует шарды.
+    Лок нужен только при регистрации шарда нового потока.
+    Гистограмма хранится как [count по бакетам..., count в +Inf, sum].
+    """
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, directory=None, interval=5):
+        self.directory = directory
+        self.interval = interval
+        self._local = threading.local()
+        self._shards = []
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = ({}, {})
+            with self._lock:
+                self._shards.append(shard)
+        return shard
+
+    def inc(self, name, labels=(), value=1):
+        counters = self._shard()[0]
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        histograms = self._shard()[1]
+        key = (name, labels)
+        hist = histograms.get(key)
+        if hist is None:
+            hist = histograms[key] = [0] * (len(self.BUCKETS) + 1) + [0.0]
+        hist[bisect.bisect_left(self.BUCKETS, value)] += 1
+        hist[-1] += value
+
+    def snapshot(self):
+        """(values, histograms) процесса: счетчики шардов плюс текущие gauge."""
+        with self._lock:
+            shards = list(self._shards)
+        values, histograms = {}, {}
+        for counters, hists in shards:
+            for key, value in list(counters.items()):
+                values[key] = values.get(key, 0) + value
+            for key, hist in list(hists.items()):
+                merge_histogram(histograms, key, list(hist))
+        for name, labels, value in process_gauges():
+            values[(name, labels)] = values.get((name, labels), 0) + value
+        return values, histograms
+
+    def ensure_writer(self):
+        if not self.directory or self._thread is not None: return
+        with self._lock:
+            if self._thread is not None: return
+            # Как и presence: поток стартует в воркере, а не в мастере gunicorn
+            self._thread = threading.Thread(target=self._run, name='metrics-writer', daemon=True)
+            self._thread.start()
+            background_threads['metrics-writer'] = self._thread
+            atexit.register(self.write)
+
+    def path_for(self, pid):
+        return os.path.join(self.directory, f"worker-{pid}.json")
+
+    def write(self):
+        with app.app_context():
+            values, histograms = self.snapshot()
+        path = self.path_for(os.getpid())
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(path + '.tmp', 'w') as f:
+                json.dump({'values': [[n, l, v] for (n, l), v in values.items()],
+                           'histograms': [[n, l, h] for (n, l), h in histograms.items()]}, f)
+            os.replace(path + '.tmp', path)
+        except OSError as e:
+            print(f"Metrics write failed: {e}")
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.write()
+
+    def collect(self):
+        """Снимок этого процесса плюс сохраненные снимки остальных воркеров."""
+        values, histograms = self.snapshot()
+        if not self.directory: return values, histograms
+        for path in glob.glob(os.path.join(self.directory, 'worker-*.json')):
+            try:
+                pid = int(os.path.basename(path)[len('worker-'):-len('.json')])
+                if pid == os.getpid(): continue
+                with open(path) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            alive = pid_alive(pid)
+            for name, labels, value in data['values']:
+                if alive or METRIC_TYPES[name][0] == 'counter':
+                    key = (name, tuple(map(tuple, labels)))
+                    values[key] = values.get(key, 0) + value
+            for name, labels, hist in data['histograms']:
+                merge_histogram(histograms, (name, tuple(map(tuple, labels))), hist)
+        return values, histograms
+
+def merge_histogram(histograms, key, hist):
+    acc = histograms.get(key)
+    if acc is None:
+        histograms[key] = hist
+    else:
+        for i, value in enumerate(hist):
+            acc[i] += value
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def process_gauges():
+    """Текущее состояние процесса: пул БД, кэши, фоновые потоки."""
+    pid = str(os.getpid())
+    rows = []
+    pool = db.engine.pool
+    for name, method in (('neural_db_pool_size', 'size'), ('neural_db_pool_checked_out', 'checkedout'),
+                         ('neural_db_pool_overflow', 'overflow')):
+        # У SQLite in-memory пулов (StaticPool/SingletonThreadPool) этих методов нет
+        if hasattr(pool, method):
+            rows.append((name, (), getattr(pool, method)()))
+    for cache_name, cache in (('tokens', token_cache), ('fragments', fragment_cache)):
+        stats = cache.stats()
+        labels = (('cache', cache_name),)
+        rows += [('neural_cache_hits_total', labels, stats['hits']),
+                 ('neural_cache_misses_total', labels, stats['misses']),
+                 ('neural_cache_entries', labels, stats['size'])]
+    with event_hub._lock:
+        rows.append(('neural_sse_subscribers', (), len(event_hub._subscribers)))
+    with presence._lock:
+        rows.append(('neural_presence_pending', (), len(presence._pending)))
+    if presence.last_flush:
+        rows.append(('neural_presence_last_flush_timestamp_seconds', (('pid', pid),), presence.last_flush))
+    rows.append(('neural_presence_flush_failures_total', (), presence.failures))
+    for thread_name, thread in list(background_threads.items()):
+        rows.append(('neural_background_thread_alive', (('thread', thread_name), ('pid', pid)), int(thread.is_alive())))
+    return rows
+
+def render_metrics(values, histograms):
+    """Текстовый формат экспозиции Prometheus 0.0.4."""
+    # Доля попаданий считается по сумме всех воркеров, а не усредняется
+    for (name, labels), hits in list(values.items()):
+        if name == 'neural_cache_hits_total':
+            total = hits + values.get(('neural_cache_misses_total', labels), 0)
+            values[('neural_cache_hit_ratio', labels)] = round(hits / total, 4) if total else 0.0
+
+    def fmt(labels, extra=()):
+        pairs = tuple(labels) + tuple(extra)
+        if not pairs: return ''
+        escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in pairs) + '}'
+
+    lines = []
+    for name, (kind, help_text) in METRIC_TYPES.items():
+        if kind == 'histogram':
+            series = sorted((labels, hist) for (n, labels), hist in histograms.items() if n == name)
+        else:
+            series = sorted((labels, value) for (n, labels), value in values.items() if n == name)
+        if not series: continue
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+        for labels, data in series:
+            if kind != 'histogram':
+                lines.append(f"{name}{fmt(labels)} {data:g}" if isinstance(data, float) else f"{name}{fmt(labels)} {data}")
+                continue
+            cumulative = 0
+            for bound, count in zip(Metrics.BUCKETS, data):
+                cumulative += count
+                lines.append(f"{name}_bucket{fmt(labels, (('le', f'{bound:g}'),))} {cumulative}")
+            cumulative += data[len(Metrics.BUCKETS)]
+            lines.append(f"{name}_bucket{fmt(labels, (('le', '+Inf'),))} {cumulative}")
+            lines.append(f"{name}_sum{fmt(labels)} {data[-1]:.6f}")
+            lines.append(f"{name}_count{fmt(labels)} {cumulative}")
+    return '\n'.join(lines) + '\n'
+
+metrics = Metrics(directory=METRICS_DIR, interval=float(os.environ.get('METRICS_FLUSH_INTERVAL', 5)))
+
+@event.listens_for(Pool, 'checkout')
+def count_pool_checkout(dbapi_connection, connection_record, connection_proxy):
+    metrics.inc('neural_db_pool_checkouts_total')
+
+@app.after_request
+def record_request_metrics(response):
+    # Шаблон маршрута, а не сам путь: иначе каждый handle и id - отдельная серия
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    stats = sql_stats()
+    metrics.inc('neural_http_requests_total', (('method', request.method), ('route', route), ('status', str(response.status_code))))
+    metrics.observe('neural_http_request_duration_seconds', (('method', request.method), ('route', route)), stats.elapsed_ms() / 1000)
+    metrics.inc('neural_db_queries_total', (('route', route),), stats.count)
+    return response
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    if request.environ.pop('neural.in_flight', False):
+        metrics.inc('neural_http_requests_in_flight', value=-1)
+
+@app.before_request
+def update_last_seen():
+    user = get_auth_user()
+    if user:
+        presence.touch(user.id)
+
+# --- СОБЫТИЯ (SSE) ---
+class EventHub:
+    """
+    In-process pub/sub для /api/stream. Каждое событие получает
+    возрастающий id и попадает в кольцевой буфер backlog, из которого
+    переподключившийся клиент дочитывает пропущенное по Last-Event-ID.
+    audience=None - событие для всех, иначе множество id пользователей.
+
+    Шина живет внутри процесса: под gunicorn подписчики видят только
+    события своего воркера, а сами воркеры должны быть потоковыми
+    (gthread/gevent), иначе каждое соединение занимает воркер целиком.
+    """
+
+    def __init__(self, backlog=1000, queue_size=256):
+        self.queue_size = queue_size
+        self._seq = 0
+        self._backlog = deque(maxlen=backlog)
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def publish(self, event, data, audience=None):
+        with self._lock:
+            self._seq += 1
+            item = (self._seq, event, data, audience)
+            self._backlog.append(item)
+            for sub in self._subscribers:
+                if audience is None or sub.user_id in audience:
+                    sub.put(item)
+
+    def subscribe(self, user_id, last_event_id=None):
+        """Возвращает подписчика и список пропущенных событий (None - нужен полный reset)."""
+        sub = Subscriber(user_id, self.queue_size)
+        with self._lock:
+            replay = []
+            if last_event_id is not None:
+                oldest = self._backlog[0][0] if self._backlog else self._seq + 1
+                # Сервер перезапускался или буфер уже вытеснил нужные события
+                if last_event_id > self._seq or last_event_id < oldest - 1:
+                    replay = None
+                else:
+                    replay = [item for item in self._backlog
+                              if item[0] > last_event_id and (item[3] is None or user_id in item[3])]
+            self._subscribers.add(sub)
+        return sub, replay
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self._subscribers.discard(sub)
+
+class Subscriber:
+    def __init__(self, user_id, queue_size):
+        self.user_id = user_id
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.lagged = False
+
+    def put(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            # Медленный клиент: вместо роста памяти попросим его перечитать состояние
+            self.lagged = True
+
+event_hub = EventHub(backlog=int(os.environ.get('EVENT_BACKLOG', 1000)))
+
+def format_sse(item, user_id):
+    seq, event, data, _ = item
+    if event == 'message':
+        data = {**data, 'isOwn': data['senderId'] == user_id}
+    return f"id: {seq}\nevent: {event}\ndata: {json.dumps(data)}\n\n"
+
+def conditional_response(etag, build):
+    """
+    Слабый ETag + If-None-Match: если у клиента уже эта версия, отвечаем
+    304 без вызова build(); иначе сериализуем build() как обычно.
+    """
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
+    return with_etag(jsonify(build()), etag)
+
+def not_modified(etag):
+    return with_etag(Response(status=304), etag)
+
+def with_etag(response, etag):
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def message_audience(msg):
+    return None if msg.recipient_id is None else {msg.sender_id, msg.recipient_id}
+
+# --- ГРАФ ДРУЗЕЙ ---
+# Журнал хранится FRIEND_LOG_RETENTION секунд. Воркер, который не
+# синхронизировался дольше половины этого срока, перечитывает граф целиком.
+FRIEND_LOG_RETENTION = int(os.environ.get('FRIEND_LOG_RETENTION', 3600))
+# Транзакции коммитятся не в порядке id: перечитываем хвост журнала с запасом.
+# Повторное применение безопасно - события идут по порядку и идемпотентны.
+FRIEND_LOG_OVERLAP = 100
+
+class FriendGraphSync:
+    """
+    FriendGraph процесса, согласованный с таблицей friends. Загружается при
+    первом обращении (под gunicorn - в каждом воркере отдельно), затем не
+    чаще раза в interval секунд дочитывает FriendEdgeEvent, который
+    respond_request и remove_friend пишут в той же транзакции, что и friends.
+    Свои изменения воркер применяет сразу после коммита.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.graph = None
+        self.position = 0
+        self.checked = 0.0
+        self.loaded_at = 0.0
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self.graph is not None and time.monotonic() - self.checked < self.interval:
+            return self.graph
+        with self._lock:
+            now = time.monotonic()
+            if self.graph is None or now - self.checked > FRIEND_LOG_RETENTION / 2:
+                self.load()
+            elif now - self.checked >= self.interval:
+                self.catch_up()
+            self.checked = time.monotonic()
+        return self.graph
+
+    def load(self):
+        # Позиция берется до чтения ребер: события между ними применятся повторно
+        position = db.session.scalar(select(func.max(FriendEdgeEvent.id))) or 0
+        started = time.perf_counter()
+        self.graph = FriendGraph.from_edges(
+            db.session.execute(select(friends_table.c.user_id, friends_table.c.friend_id)))
+        self.position = position
+        self.loaded_at = time.time()
+        print(f"--- FRIEND GRAPH LOADED: {self.graph.stats()} in {time.perf_counter() - started:.2f}s ---")
+
+    def catch_up(self):
+        events = db.session.execute(
+            select(FriendEdgeEvent.id, FriendEdgeEvent.user_id, FriendEdgeEvent.friend_id, FriendEdgeEvent.added)
+            .where(FriendEdgeEvent.id > self.position - FRIEND_LOG_OVERLAP)
+            .order_by(FriendEdgeEvent.id)).all()
+        for event_id, user_id, friend_id, added in events:
+            self.apply(user_id, friend_id, added)
+            self.position = max(self.position, event_id)
+
+    def apply(self, user_id, friend_id, added):
+        if self.graph is None: return
+        if added:
+            self.graph.add(user_id, friend_id)
+        else:
+            self.graph.remove(user_id, friend_id)
+
+friend_graph = FriendGraphSync(interval=float(os.environ.get('FRIEND_GRAPH_SYNC_INTERVAL', 1)))
+
+def log_friend_edge(user_id, friend_id, added):
+    """Пишет событие в журнал в текущей транзакции и подрезает старые записи."""
+    db.session.add(FriendEdgeEvent(user_id=user_id, friend_id=friend_id, added=added))
+    if random.random() < 0.01:
+        cutoff = datetime.utcnow() - timedelta(seconds=FRIEND_LOG_RETENTION)
+        db.session.execute(delete(FriendEdgeEvent).where(FriendEdgeEvent.timestamp < cutoff))
+
+# --- ЛЕНТА ДРУЗЕЙ ---
+# Пост автора с числом друзей до TIMELINE_FANOUT_MAX раскладывается по лентам
+# друзей при записи. Посты авторов-«хабов» не раскладываются: читатели
+# дочитывают их сами. Граница считается по степени в friend_graph, поэтому
+# запись и чтение решают одинаково. Если автор пересек границу вверх, его посты
+# могут попасть в оба источника - чтение убирает дубли по id. Вниз (удаление
+# из друзей) - последние посты раскладываются заново, см. fan_out_former_hub.
+TIMELINE_FANOUT_MAX = int(os.environ.get('TIMELINE_FANOUT_MAX', 500))
+# Сколько последних постов нового друга добавить в ленту при принятии заявки
+TIMELINE_BACKFILL = 50
+
+TIMELINE_COLUMNS = ['user_id', 'post_id', 'author_id', 'timestamp']
+
+def is_high_degree(user_id):
+    return friend_graph.get().degree(user_id) > TIMELINE_FANOUT_MAX
+
+def timeline_insert(rows):
+    """INSERT INTO timeline ... SELECT rows ON CONFLICT DO NOTHING - повтор безопасен."""
+    dialect = postgresql if db.engine.dialect.name == 'postgresql' else sqlite
+    # SQLite требует WHERE у SELECT, иначе ON CONFLICT разбирается как часть JOIN ... ON
+    rows = rows.where(true())
+    db.session.execute(dialect.insert(TimelineEntry).from_select(TIMELINE_COLUMNS, rows).on_conflict_do_nothing())
+
+def fan_out_post(post):
+    """В ленту автора и, если он не «хаб», в ленты всех его друзей - одним INSERT ... SELECT."""
+    db.session.add(TimelineEntry(user_id=post.user_id, post_id=post.id, author_id=post.user_id, timestamp=post.timestamp))
+    if is_high_degree(post.user_id): return
+    timeline_insert(select(friends_table.c.friend_id, literal(post.id), literal(post.user_id),
+                           literal(post.timestamp, db.DateTime))
+                    .where(friends_table.c.user_id == post.user_id))
+
+def link_timelines(user_id, friend_id):
+    """Новая дружба: последние посты каждого попадают в ленту другого."""
+    for owner, author in ((user_id, friend_id), (friend_id, user_id)):
+        if is_high_degree(author): continue
+        timeline_insert(select(literal(owner), Post.id, Post.user_id, Post.timestamp)
+                        .where(Post.user_id == author)
+                        .order_by(Post.timestamp.desc()).limit(TIMELINE_BACKFILL))
+
+def fan_out_former_hub(author_id):
+    """
+    Автор перестает быть «хабом»: читатели больше не дочитывают его посты,
+    поэтому последние TIMELINE_BACKFILL из них раскладываются по лентам
+    оставшихся друзей. Вызывается после удаления ребра из friends: степень
+    считается по таблице в той же транзакции, а не по friend_graph, который
+    меняется только после коммита.
+    """
+    degree = db.session.scalar(select(func.count()).select_from(friends_table)
+                               .where(friends_table.c.user_id == author_id))
+    if degree != TIMELINE_FANOUT_MAX: return
+    recent = (select(Post.id, Post.user_id, Post.timestamp).where(Post.user_id == author_id)
+              .order_by(Post.timestamp.desc()).limit(TIMELINE_BACKFILL).subquery())
+    timeline_insert(select(friends_table.c.friend_id, recent.c.id, recent.c.user_id, recent.c.timestamp)
+                    .join(recent, recent.c.user_id == friends_table.c.user_id))
+
+def unlink_timelines(user_id, friend_id):
+    db.session.execute(delete(TimelineEntry).where(or_(
+        and_(TimelineEntry.user_id == user_id, TimelineEntry.author_id == friend_id),
+        and_(TimelineEntry.user_id == friend_id, TimelineEntry.author_id == user_id))))
+
+def backfill_timelines():
+    """
+    Ленты для всех существующих постов: свои посты и посты друзей, кроме
+    «хабов». Степень считается по friends, а не по User.friends_count: в
+    миграции колонка может быть еще не пересчитана.
+    """
+    hubs = (select(friends_table.c.user_id).group_by(friends_table.c.user_id)
+            .having(func.count() > TIMELINE_FANOUT_MAX))
+    timeline_insert(select(Post.user_id, Post.id, Post.user_id, Post.timestamp))
+    timeline_insert(select(friends_table.c.user_id, Post.id, Post.user_id, Post.timestamp)
+                    .join(Post, Post.user_id == friends_table.c.friend_id)
+                    .where(Post.user_id.not_in(hubs)))
+    db.session.commit()
 
 # --- ФУНКЦИИ ---
 def generate_invite_code():
     chars = string.ascii_uppercase + string.digits
     return f"NEURAL-{''.join(random.choice(chars) for _ in range(4))}-{''.join(random.choice(chars) for _ in range(4))}"
 
+def are_friends(user_id, other_id):
+    return db.session.query(friends_table).filter_by(user_id=user_id, friend_id=other_id).first() is not None
+
+# При нескольких связях побеждает более сильная: дружба, затем исходящая заявка
+FRIEND_STATUS_PRIORITY = {'friends': 0, 'pending_sent': 1, 'pending_received': 2}
+
+def friend_statuses(viewer_id, user_ids):
+    """
+    id -> friendStatus зрителя для каждого из user_ids одним запросом:
+    UNION ALL трех выборок по индексам (friends PK, uq_friend_request_pair,
+    ix_friend_request_receiver). Для анонимного зрителя и самого себя - 'none'.
+    """
+    result = dict.fromkeys(user_ids, 'none')
+    targets = [uid for uid in result if uid != viewer_id]
+    if not viewer_id or not targets: return result
+    rows = db.session.execute(
+        select(friends_table.c.friend_id, literal_column("'friends'"))
+        .where(friends_table.c.user_id == viewer_id, friends_table.c.friend_id.in_(targets))
+        .union_all(
+            select(FriendRequest.receiver_id, literal_column("'pending_sent'"))
+            .where(FriendRequest.sender_id == viewer_id, FriendRequest.receiver_id.in_(targets)),
+            select(FriendRequest.sender_id, literal_column("'pending_received'"))
+            .where(FriendRequest.receiver_id == viewer_id, FriendRequest.sender_id.in_(targets))
+        )
+    ).all()
+    for uid, status in sorted(rows, key=lambda r: FRIEND_STATUS_PRIORITY[r[1]], reverse=True):
+        result[uid] = status
+    return result
+
 def find_user_by_handle(handle_str):
     if not handle_str: return None
     u = User.query.filter_by(handle=handle_str).first()
@@ -232,6 +1192,599 @@ def find_user_by_handle(handle_str):
         u = User.query.filter_by(handle='@' + handle_str).first()
     return u
 
+FEED_PAGE_DEFAULT = 20
+FEED_PAGE_MAX = 100
+
+def encode_cursor(timestamp, row_id):
+    return f"{timestamp.isoformat()}_{row_id}"
+
+def decode_cursor(cursor):
+    # Курсор вида "<ISO-время>_<id>"; битый курсор = первая страница
+    if not cursor: return None
+    try:
+        ts, row_id = cursor.rsplit('_', 1)
+        return datetime.fromisoformat(ts), int(row_id)
+    except ValueError:
+        return None
+
+def parse_limit(default=FEED_PAGE_DEFAULT, maximum=FEED_PAGE_MAX):
+    try:
+        limit = int(request.args.get('limit', default))
+    except ValueError:
+        limit = default
+    return max(1, min(limit, maximum))
+
+def paginate_keyset(query, ts_column, id_column, limit, cursor_of):
+    """
+    Keyset-пагинация по убыванию (ts_column, id_column): каждая страница -
+    один range scan по составному индексу, независимо от глубины списка.
+    cursor_of(row) возвращает пару (timestamp, id) для курсора следующей страницы.
+    """
+    cursor = decode_cursor(request.args.get('before'))
+    if cursor:
+        ts, row_id = cursor
+        query = query.filter(or_(
+            ts_column < ts,
+            and_(ts_column == ts, id_column < row_id)
+        ))
+    rows = query.order_by(ts_column.desc(), id_column.desc()).limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(*cursor_of(rows[-1]))
+    return rows, next_cursor
+
+def paginate_posts(query, limit):
+    return paginate_keyset(query, Post.timestamp, Post.id, limit, lambda p: (p.timestamp, p.id))
+
+def user_fragments(user_ids):
+    """
+    id -> User.public_dict() из fragment_cache. Ключи берутся узким IN-запросом
+    по PK (только колонки USER_FRAGMENT_STATE), недостающие карточки - вторым.
+    """
+    if not user_ids: return {}
+    keys = {row.id: ('user', *row) for row in db.session.execute(
+        select(*USER_FRAGMENT_STATE).where(User.id.in_(user_ids)))}
+    result, missing = {}, []
+    for user_id, key in keys.items():
+        cached = fragment_cache.get(key)
+        if cached is None:
+            missing.append(user_id)
+        else:
+            result[user_id] = cached
+    if missing:
+        for u in User.query.filter(User.id.in_(missing)).all():
+            result[u.id] = u.public_dict()
+            fragment_cache.set(u.fragment_key, result[u.id])
+    return result
+
+def serialize_posts(posts, current_user_id=None):
+    """
+    Пакетная сериализация страницы постов: тот же JSON, что и Post.to_dict,
+    но фиксированное число сгруппированных запросов вместо N+1 на каждый пост.
+    Общие части постов и авторов берутся из fragment_cache, так что на
+    прогретом кэше остается один запрос - лайки текущего зрителя.
+    """
+    if not posts: return []
+    post_ids = [p.id for p in posts]
+
+    liked = set()
+    if current_user_id:
+        liked = {row.post_id for row in db.session.query(PostLike.post_id)
+                 .filter(PostLike.post_id.in_(post_ids), PostLike.user_id == current_user_id)}
+
+    fragments = {p.id: fragment_cache.get(p.fragment_key) for p in posts}
+    missing = [p for p in posts if fragments[p.id] is None]
+    if missing:
+        comments = {}
+        for comment in (Comment.query.filter(Comment.post_id.in_([p.id for p in missing]))
+                        .order_by(Comment.id).all()):
+            comments.setdefault(comment.post_id, []).append(comment.public_dict())
+        for p in missing:
+            fragments[p.id] = p.public_dict(comments.get(p.id, []))
+            fragment_cache.set(p.fragment_key, fragments[p.id])
+
+    user_ids = {p.user_id for p in posts}
+    for fragment in fragments.values():
+        user_ids.update(c['userId'] for c in fragment['comments'])
+    users = user_fragments(user_ids)
+
+    return [{
+        **fragments[p.id],
+        'author': User.assemble(users[p.user_id]),
+        'isLiked': p.id in liked,
+        'comments': [Comment.assemble(c, users[c['userId']]) for c in fragments[p.id]['comments']]
+    } for p in posts]
+
+# --- ТРЕНДЫ ---
+# Счет поста - сумма весов лайков и комментариев, затухающая вдвое каждые
+# TRENDING_HALF_LIFE секунд. Чтобы не пересчитывать затухание, в колонке
+# trending_score хранится сумма w * 2^(возраст поста в момент события / half_life):
+# это атомарный UPDATE score = score + delta, как у остальных счетчиков.
+# Затухший счет на момент now равен score * 2^((timestamp - now) / half_life).
+TRENDING_HALF_LIFE = float(os.environ.get('TRENDING_HALF_LIFE_HOURS', 6)) * 3600
+# События на постах старше окна не учитываются и такие посты не попадают в тренды
+TRENDING_WINDOW = float(os.environ.get('TRENDING_WINDOW_HOURS', 72)) * 3600
+TRENDING_WEIGHTS = {'like': 1.0, 'comment': 2.0}
+TRENDING_EPOCH = datetime(2020, 1, 1)
+
+def trending_delta(post_timestamp, weight, at=None):
+    age = ((at or datetime.utcnow()) - post_timestamp).total_seconds()
+    if age > TRENDING_WINDOW: return 0.0
+    return weight * 2 ** (max(age, 0) / TRENDING_HALF_LIFE)
+
+def bump_trending(post_id, post_timestamp, weight, at=None):
+    """
+    Атомарно меняет trending_score в текущей транзакции, возвращает новое
+    значение (None - событие вне окна). Отрицательный weight с at - время
+    снимаемого события - вычитает ровно его вклад, как его посчитал бы
+    reconcile_trending; счет не опускается ниже нуля из-за округлений.
+    """
+    delta = trending_delta(post_timestamp, abs(weight), at=at)
+    if not delta: return None
+    if weight < 0:
+        value = case((Post.trending_score > delta, Post.trending_score - delta), else_=0.0)
+    else:
+        value = Post.trending_score + delta
+    return db.session.execute(update(Post).where(Post.id == post_id)
+                              .values(trending_score=value).returning(Post.trending_score)).scalar()
+
+def trending_key(post_timestamp, score):
+    """
+    Ключ ранжирования log2 затухшего счета плюс now / half_life. Слагаемое
+    с now одинаково для всех постов, так что порядок ключей не меняется со
+    временем и top-K не нужно пересортировывать по часам.
+    """
+    return math.log2(score) + (post_timestamp - TRENDING_EPOCH).total_seconds() / TRENDING_HALF_LIFE
+
+class TrendingBoard:
+    """
+    Ограниченный top-K постов по трендовости в памяти процесса. Лайки и
+    комментарии этого процесса обновляют его сразу после коммита; раз в
+    refresh секунд он перечитывается из trending_score (там события всех
+    воркеров) одним range scan по постам окна.
+    """
+
+    def __init__(self, size, refresh):
+        self.size = size
+        self.refresh = refresh
+        self._entries = {}  # post_id -> (ключ, timestamp)
+        self._lock = threading.Lock()
+        self._loaded = None
+
+    def offer(self, post_id, post_timestamp, score):
+        with self._lock:
+            if not score or score <= 0:
+                self._entries.pop(post_id, None)
+                return
+            entry = (trending_key(post_timestamp, score), post_timestamp)
+            if post_id in self._entries or len(self._entries) < self.size:
+                self._entries[post_id] = entry
+                return
+            # K небольшое - линейный поиск минимума дешевле поддержки кучи с обновлениями
+            worst = min(self._entries, key=lambda pid: self._entries[pid][0])
+            if self._entries[worst][0] < entry[0]:
+                del self._entries[worst]
+                self._entries[post_id] = entry
+
+    def load(self):
+        cutoff = datetime.utcnow() - timedelta(seconds=TRENDING_WINDOW)
+        rows = db.session.execute(select(Post.id, Post.timestamp, Post.trending_score)
+                                  .where(Post.timestamp >= cutoff, Post.trending_score > 0)).all()
+        best = heapq.nlargest(self.size, ((trending_key(ts, score), pid, ts) for pid, ts, score in rows))
+        with self._lock:
+            self._entries = {pid: (key, ts) for key, pid, ts in best}
+            self._loaded = time.monotonic()
+
+    def top(self, limit):
+        """[(post_id, затухший счет на сейчас), ...] по убыванию."""
+        if self._loaded is None or time.monotonic() - self._loaded >= self.refresh:
+            self.load()
+        now = datetime.utcnow()
+        cutoff = now - timedelta(seconds=TRENDING_WINDOW)
+        now_key = (now - TRENDING_EPOCH).total_seconds() / TRENDING_HALF_LIFE
+        with self._lock:
+            ranked = sorted(((key, pid) for pid, (key, ts) in self._entries.items() if ts >= cutoff), reverse=True)
+        return [(pid, 2 ** (key - now_key)) for key, pid in ranked[:limit]]
+
+trending = TrendingBoard(size=int(os.environ.get('TRENDING_TOP_K', 100)),
+                         refresh=float(os.environ.get('TRENDING_REFRESH', 60)))
+
+def reconcile_trending():
+    """
+    Пересчет trending_score по лайкам и комментариям окна с теми же вкладами,
+    что и при живом обновлении. События без времени (до миграций) не учитываются.
+    """
+    cutoff = datetime.utcnow() - timedelta(seconds=TRENDING_WINDOW)
+    db.session.execute(update(Post).where(Post.trending_score != 0).values(trending_score=0))
+    scores = {}
+    for pid, post_ts, like_ts in (db.session.query(Post.id, Post.timestamp, PostLike.timestamp)
+                                  .join(PostLike, PostLike.post_id == Post.id).filter(Post.timestamp >= cutoff)):
+        if like_ts:
+            scores[pid] = scores.get(pid, 0.0) + trending_delta(post_ts, TRENDING_WEIGHTS['like'], at=like_ts)
+    for pid, post_ts, comment_ts in (db.session.query(Post.id, Post.timestamp, Comment.timestamp)
+                                     .join(Comment, Comment.post_id == Post.id).filter(Post.timestamp >= cutoff)):
+        if comment_ts:
+            scores[pid] = scores.get(pid, 0.0) + trending_delta(post_ts, TRENDING_WEIGHTS['comment'], at=comment_ts)
+    if scores:
+        db.session.execute(update(Post), [{'id': pid, 'trending_score': score} for pid, score in scores.items()])
+
+def bump_counters(model, pk, **deltas):
+    # Атомарный UPDATE col = col + delta внутри текущей транзакции
+    values = {getattr(model, col): getattr(model, col) + delta for col, delta in deltas.items()}
+    db.session.execute(update(model).where(model.id == pk).values(values))
+
+def bump_versions(*names):
+    db.session.execute(update(CollectionVersion)
+                       .where(CollectionVersion.name.in_(names))
+                       .values(version=CollectionVersion.version + 1))
+
+def get_versions(*names):
+    rows = dict(db.session.query(CollectionVersion.name, CollectionVersion.version)
+                .filter(CollectionVersion.name.in_(names)).all())
+    return '.'.join(str(rows.get(name, 0)) for name in names)
+
+def insert_ignore(model, conflict_columns, where=None, **values):
+    """
+    INSERT ... ON CONFLICT DO NOTHING по уникальному ключу conflict_columns.
+    С where - INSERT ... SELECT ... WHERE where: строка не вставляется, если
+    условие ложно (например, цели внешнего ключа нет - ON CONFLICT покрывает
+    только уникальный индекс, и Postgres упал бы на проверке FK).
+    True, если строка действительно вставлена.
+    """
+    dialect = postgresql if db.engine.dialect.name == 'postgresql' else sqlite
+    if where is None:
+        stmt = dialect.insert(model).values(**values)
+    else:
+        stmt = dialect.insert(model).from_select(list(values), select(*(literal(v) for v in values.values())).where(where))
+    stmt = stmt.on_conflict_do_nothing(index_elements=conflict_columns)
+    return db.session.execute(stmt).rowcount == 1
+
+def set_like(like_model, target_model, target_column, target_id, user_id, liked):
+    """
+    Идемпотентно ставит/снимает лайк: INSERT ON CONFLICT DO NOTHING или DELETE
+    по уникальному ключу, без чтения перед записью. Счетчик цели меняется
+    только если строка реально добавилась/удалилась, новое значение берется
+    из RETURNING. Возвращает (счетчик, изменилось ли что-то, строку цели,
+    удаленную строку лайка или None) или None, если цели нет. Коммит
+    остается за вызывающим.
+    """
+    removed = None
+    if liked:
+        changed = insert_ignore(like_model, [target_column, 'user_id'], user_id=user_id, **{target_column: target_id},
+                                where=select(target_model.id).where(target_model.id == target_id).exists())
+    else:
+        removed = db.session.execute(delete(like_model).where(
+            like_model.user_id == user_id, getattr(like_model, target_column) == target_id
+        ).returning(*like_model.__table__.c)).first()
+        changed = removed is not None
+
+    returning = [target_model.likes_count] + ([target_model.user_id, target_model.timestamp] if target_model is Post else [])
+    if changed:
+        row = db.session.execute(update(target_model).where(target_model.id == target_id)
+                                 .values(likes_count=target_model.likes_count + (1 if liked else -1))
+                                 .returning(*returning)).first()
+    else:
+        row = db.session.execute(select(*returning).where(target_model.id == target_id)).first()
+    if row is None:
+        db.session.rollback()
+        return None
+    return row[0], changed, row, removed
+
+def reconcile_counters():
+    """
+    Пересчитывает все денормализованные счетчики пачкой GROUP BY-запросов.
+    Нужна после миграции и для исправления расхождений.
+    """
+    db.session.execute(update(User).values(reputation=0, posts_count=0, friends_count=0))
+    db.session.execute(update(Post).values(likes_count=0, comments_count=0))
+
+    posts = {}
+    for pid, n in db.session.query(PostLike.post_id, func.count(PostLike.id)).group_by(PostLike.post_id):
+        posts.setdefault(pid, {'id': pid})['likes_count'] = n
+    for pid, n in db.session.query(Comment.post_id, func.count(Comment.id)).group_by(Comment.post_id):
+        posts.setdefault(pid, {'id': pid})['comments_count'] = n
+    rows = [{'likes_count': 0, 'comments_count': 0, **p} for p in posts.values()]
+    if rows:
+        db.session.execute(update(Post), rows)
+
+    db.session.execute(update(Track).values(likes_count=0))
+    track_likes = db.session.query(TrackLike.track_id, func.count(TrackLike.id)).group_by(TrackLike.track_id).all()
+    if track_likes:
+        db.session.execute(update(Track), [{'id': tid, 'likes_count': n} for tid, n in track_likes])
+
+    users = {}
+    for uid, n in (db.session.query(Post.user_id, func.count(PostLike.id))
+                   .join(PostLike, PostLike.post_id == Post.id).group_by(Post.user_id)):
+        users.setdefault(uid, {'id': uid})['reputation'] = n
+    for uid, n in db.session.query(Post.user_id, func.count(Post.id)).group_by(Post.user_id):
+        users.setdefault(uid, {'id': uid})['posts_count'] = n
+    for uid, n in (db.session.query(friends_table.c.user_id, func.count())
+                   .group_by(friends_table.c.user_id)):
+        users.setdefault(uid, {'id': uid})['friends_count'] = n
+    # executemany требует одинаковый набор ключей в каждой строке
+    rows = [{'reputation': 0, 'posts_count': 0, 'friends_count': 0, **u} for u in users.values()]
+    if rows:
+        db.session.execute(update(User), rows)
+    reconcile_trending()
+    db.session.commit()
+
+def backfill_conversation_keys():
+    db.session.execute(update(Message).values(conversation_key=case(
+        (Message.recipient_id.is_(None), Message.PUBLIC_KEY),
+        (Message.sender_id < Message.recipient_id, Message.sender_id + ':' + Message.recipient_id),
+        else_=Message.recipient_id + ':' + Message.sender_id
+    )))
+    db.session.commit()
+
+@app.cli.command('reconcile-counters')
+def reconcile_counters_command():
+    reconcile_counters()
+    print("--- COUNTERS RECONCILED ---")
+
+# --- МИГРАЦИИ ---
+# create_all создает только отсутствующие таблицы, поэтому изменения
+# существующих таблиц оформляются шагами ниже. Каждый шаг идемпотентен:
+# на свежей базе, созданной create_all, он просто ничего не делает.
+
+def add_column(table_name, column_name):
+    if column_name in {c['name'] for c in inspect(db.engine).get_columns(table_name)}: return False
+    column = db.metadata.tables[table_name].c[column_name]
+    quote = db.engine.dialect.identifier_preparer.quote
+    ddl = f"ALTER TABLE {quote(table_name)} ADD COLUMN {quote(column_name)} {column.type.compile(db.engine.dialect)}"
+    if column.server_default is not None:
+        ddl += f" DEFAULT {column.server_default.arg} NOT NULL"
+    with db.engine.begin() as conn:
+        conn.execute(text(ddl))
+    return True
+
+def create_index(table_name, index_name):
+    index = next(ix for ix in db.metadata.tables[table_name].indexes if ix.name == index_name)
+    with db.engine.begin() as conn:
+        conn.execute(CreateIndex(index, if_not_exists=True))
+
+def remove_duplicates(model, *columns):
+    # Перед UNIQUE-индексом оставляем по одной (самой ранней) строке на ключ
+    keep = db.session.query(func.min(model.id)).group_by(*columns).scalar_subquery()
+    db.session.execute(model.__table__.delete().where(model.id.not_in(keep)))
+    db.session.commit()
+
+def migration_feed_index():
+    create_index('post', 'ix_post_timestamp_id')
+
+def migration_counters():
+    added = [add_column('user', name) for name in ('reputation', 'posts_count', 'friends_count')]
+    added.append(add_column('post', 'likes_count'))
+    return any(added)
+
+def migration_conversation_key():
+    if add_column('message', 'conversation_key'):
+        backfill_conversation_keys()
+    create_index('message', 'ix_message_conversation_id')
+
+def migration_hot_lookup_indexes():
+    remove_duplicates(PostLike, PostLike.post_id, PostLike.user_id)
+    remove_duplicates(TrackLike, TrackLike.user_id, TrackLike.track_id)
+    remove_duplicates(FriendRequest, FriendRequest.sender_id, FriendRequest.receiver_id)
+    for table_name, index_name in [
+        ('post_like', 'uq_post_like_post_user'),
+        ('post_like', 'ix_post_like_user_timestamp'),
+        ('comment', 'ix_comment_post_id'),
+        ('message', 'ix_message_recipient_timestamp'),
+        ('friend_request', 'ix_friend_request_receiver'),
+        ('friend_request', 'uq_friend_request_pair'),
+        ('track_like', 'uq_track_like_user_track'),
+    ]:
+        create_index(table_name, index_name)
+    # Удаленные дубли лайков могли завысить счетчики
+    return True
+
+def migration_collection_versions():
+    existing = {row.name for row in db.session.query(CollectionVersion.name)}
+    for name in CollectionVersion.NAMES:
+        if name not in existing:
+            db.session.add(CollectionVersion(name=name, version=0))
+    db.session.commit()
+
+def migration_user_search():
+    create_index('user', 'ix_user_name_lower')
+    create_index('user', 'ix_user_handle_lower')
+    with db.engine.begin() as conn:
+        if db.engine.dialect.name == 'postgresql':
+            conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+            conn.execute(text('CREATE INDEX IF NOT EXISTS ix_user_name_trgm ON "user" USING gin (name gin_trgm_ops)'))
+            conn.execute(text('CREATE INDEX IF NOT EXISTS ix_user_handle_trgm ON "user" USING gin (handle gin_trgm_ops)'))
+        elif db.engine.dialect.name == 'sqlite':
+            create_user_search(conn)
+
+def create_user_search(conn):
+    """
+    FTS5-индекс имен и хэндлов, синхронизируется триггерами. У "user"
+    строковый PK, а неявный rowid такой таблицы VACUUM может перенумеровать,
+    поэтому индекс хранит собственную копию id (UNINDEXED), а не ссылается
+    на rowid. Удаление по id - проход по индексу, но имена меняются редко.
+    """
+    conn.execute(text("""CREATE VIRTUAL TABLE IF NOT EXISTS user_search USING fts5(
+        id UNINDEXED, name, handle, tokenize='trigram')"""))
+    conn.execute(text("""CREATE TRIGGER IF NOT EXISTS user_search_ai AFTER INSERT ON "user" BEGIN
+        INSERT INTO user_search(id, name, handle) VALUES (new.id, new.name, new.handle);
+    END"""))
+    conn.execute(text("""CREATE TRIGGER IF NOT EXISTS user_search_ad AFTER DELETE ON "user" BEGIN
+        DELETE FROM user_search WHERE id = old.id;
+    END"""))
+    conn.execute(text("""CREATE TRIGGER IF NOT EXISTS user_search_au AFTER UPDATE OF id, name, handle ON "user" BEGIN
+        DELETE FROM user_search WHERE id = old.id;
+        INSERT INTO user_search(id, name, handle) VALUES (new.id, new.name, new.handle);
+    END"""))
+    conn.execute(text("DELETE FROM user_search"))
+    conn.execute(text('INSERT INTO user_search(id, name, handle) SELECT id, name, handle FROM "user"'))
+
+def migration_post_search():
+    with db.engine.begin() as conn:
+        if db.engine.dialect.name == 'postgresql':
+            conn.execute(text("CREATE INDEX IF NOT EXISTS ix_post_content_fts ON post USING gin (to_tsvector('simple', content))"))
+        elif db.engine.dialect.name == 'sqlite':
+            conn.execute(text("""CREATE VIRTUAL TABLE IF NOT EXISTS post_search USING fts5(
+                content, content='post', content_rowid='id', tokenize='unicode61 remove_diacritics 2')"""))
+            conn.execute(text("""CREATE TRIGGER IF NOT EXISTS post_search_ai AFTER INSERT ON post BEGIN
+                INSERT INTO post_search(rowid, content) VALUES (new.id, new.content);
+            END"""))
+            conn.execute(text("""CREATE TRIGGER IF NOT EXISTS post_search_ad AFTER DELETE ON post BEGIN
+                INSERT INTO post_search(post_search, rowid, content) VALUES ('delete', old.id, old.content);
+            END"""))
+            conn.execute(text("""CREATE TRIGGER IF NOT EXISTS post_search_au AFTER UPDATE OF content ON post BEGIN
+                INSERT INTO post_search(post_search, rowid, content) VALUES ('delete', old.id, old.content);
+                INSERT INTO post_search(rowid, content) VALUES (new.id, new.content);
+            END"""))
+            conn.execute(text("INSERT INTO post_search(post_search) VALUES ('rebuild')"))
+
+def migration_profile_posts_index():
+    create_index('post', 'ix_post_user_timestamp_id')
+
+def migration_comments_count():
+    return add_column('post', 'comments_count')
+
+def migration_track_likes_count():
+    return add_column('track', 'likes_count')
+
+def migration_friend_request_inbox_index():
+    # Индекс был одноколоночным; create_all на свежей базе уже создал новый
+    existing = {ix['name']: ix['column_names'] for ix in inspect(db.engine).get_indexes('friend_request')}
+    if existing.get('ix_friend_request_receiver') == ['receiver_id']:
+        with db.engine.begin() as conn:
+            conn.execute(text("DROP INDEX ix_friend_request_receiver"))
+    create_index('friend_request', 'ix_friend_request_receiver')
+
+def migration_timeline():
+    backfill_timelines()
+
+def migration_trending_score():
+    return add_column('post', 'trending_score')
+
+def migration_user_search_ids():
+    # Индекс из миграции 6 ссылался на rowid таблицы "user" - пересоздаем его с id
+    if db.engine.dialect.name != 'sqlite': return
+    with db.engine.begin() as conn:
+        columns = {row[1] for row in conn.execute(text("SELECT * FROM pragma_table_info('user_search')"))}
+        if 'id' in columns: return
+        for trigger in ('user_search_ai', 'user_search_ad', 'user_search_au'):
+            conn.execute(text(f"DROP TRIGGER IF EXISTS {trigger}"))
+        conn.execute(text("DROP TABLE IF EXISTS user_search"))
+        create_user_search(conn)
+
+def migration_profile_version():
+    add_column('user', 'profile_version')
+
+def migration_comment_timestamp():
+    # Пересчет нужен трендам: комментарии теперь учитываются по своему времени
+    return add_column('comment', 'timestamp')
+
+MIGRATIONS = [
+    (1, 'feed (timestamp, id) index', migration_feed_index),
+    (2, 'denormalized counters', migration_counters),
+    (3, 'message conversation key', migration_conversation_key),
+    (4, 'hot lookup indexes', migration_hot_lookup_indexes),
+    (5, 'collection versions', migration_collection_versions),
+    (6, 'user search index', migration_user_search),
+    (7, 'post full-text index', migration_post_search),
+    (8, 'profile posts index', migration_profile_posts_index),
+    (9, 'post comments counter', migration_comments_count),
+    (10, 'track likes counter', migration_track_likes_count),
+    (11, 'friend request inbox index', migration_friend_request_inbox_index),
+    (12, 'friends timeline backfill', migration_timeline),
+    (13, 'post trending score', migration_trending_score),
+    (14, 'user search index keyed by id', migration_user_search_ids),
+    (15, 'user profile version', migration_profile_version),
+    (16, 'comment timestamp', migration_comment_timestamp),
+]
+
+def run_migrations():
+    """
+    Применяет шаги из MIGRATIONS, которых еще нет в таблице schema_version.
+    Шаг возвращает True, если после него нужно пересчитать счетчики - это
+    делается один раз в конце, когда все колонки уже на месте.
+    Работает и на SQLite, и на Postgres. Возвращает список примененных версий.
+    """
+    with db.engine.begin() as conn:
+        conn.execute(text("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, applied_at VARCHAR(32))"))
+        current = conn.execute(text("SELECT MAX(version) FROM schema_version")).scalar() or 0
+    applied = []
+    needs_reconcile = False
+    for version, title, step in MIGRATIONS:
+        if version <= current: continue
+        print(f"--- MIGRATION {version}: {title} ---")
+        needs_reconcile = step() or needs_reconcile
+        with db.engine.begin() as conn:
+            conn.execute(text("INSERT INTO schema_version (version, applied_at) VALUES (:v, :t)"),
+                         {'v': version, 't': datetime.utcnow().isoformat()})
+        applied.append(version)
+    if needs_reconcile:
+        reconcile_counters()
+    return applied
+
+@app.cli.command('migrate')
+def migrate_command():
+    db.create_all()
+    print(f"--- SCHEMA UP TO DATE, APPLIED: {run_migrations() or 'nothing'} ---")
+
+# Запросы горячих эндпоинтов и индекс, который каждый из них обязан использовать
+QUERY_PLAN_CHECKS = [
+    ('GET /api/posts: page', 'ix_post_timestamp_id',
+     lambda: Post.query.order_by(Post.timestamp.desc(), Post.id.desc()).limit(20)),
+    ('GET /api/posts: isLiked', 'uq_post_like_post_user',
+     lambda: PostLike.query.filter(PostLike.post_id.in_([1, 2, 3]), PostLike.user_id == 'x')),
+    ('GET /api/posts: comments', 'ix_comment_post_id',
+     lambda: Comment.query.filter(Comment.post_id.in_([1, 2, 3]))),
+    ('GET /api/users/<handle>/posts', 'ix_post_user_timestamp_id',
+     lambda: Post.query.filter(Post.user_id == 'x').order_by(Post.timestamp.desc(), Post.id.desc()).limit(20)),
+    ('GET /api/users/<handle>/liked', 'ix_post_like_user_timestamp',
+     lambda: PostLike.query.filter(PostLike.user_id == 'x').order_by(PostLike.timestamp.desc()).limit(5)),
+    ('GET /api/messages: conversation', 'ix_message_conversation_id',
+     lambda: Message.query.filter(Message.conversation_key == 'public', Message.id > 0).order_by(Message.id)),
+    ('GET /api/messages: inbox', 'ix_message_recipient_timestamp',
+     lambda: Message.query.filter(Message.recipient_id == 'x').order_by(Message.timestamp)),
+    ('GET /api/friends/requests', 'ix_friend_request_receiver',
+     lambda: FriendRequest.query.filter(FriendRequest.receiver_id == 'x', FriendRequest.id < 10)
+             .order_by(FriendRequest.id.desc()).limit(50)),
+    ('GET /api/friends/requests?count_only=1', 'ix_friend_request_receiver',
+     lambda: db.session.query(func.count(FriendRequest.id)).filter(FriendRequest.receiver_id == 'x')),
+    ('GET /api/timeline', 'ix_timeline_user_timestamp_post',
+     lambda: TimelineEntry.query.filter(TimelineEntry.user_id == 'x')
+             .order_by(TimelineEntry.timestamp.desc(), TimelineEntry.post_id.desc()).limit(20)),
+    ('POST /api/friends/request: existing', 'uq_friend_request_pair',
+     lambda: FriendRequest.query.filter_by(sender_id='x', receiver_id='y')),
+    ('POST /api/music/<id>/like: existing', 'uq_track_like_user_track',
+     lambda: TrackLike.query.filter_by(user_id='x', track_id=1)),
+]
+
+def explain(query):
+    sql = str(query.statement.compile(db.engine, compile_kwargs={'literal_binds': True}))
+    if db.engine.dialect.name == 'sqlite':
+        return '\n'.join(row[-1] for row in db.session.execute(text('EXPLAIN QUERY PLAN ' + sql)))
+    # На маленьких таблицах планировщик Postgres предпочитает seq scan - запрещаем его
+    db.session.execute(text('SET LOCAL enable_seqscan = off'))
+    return '\n'.join(row[0] for row in db.session.execute(text('EXPLAIN ' + sql)))
+
+def check_query_plans():
+    """Возвращает [(endpoint, индекс, план, ok)] для QUERY_PLAN_CHECKS."""
+    results = []
+    for label, index_name, build in QUERY_PLAN_CHECKS:
+        plan = explain(build())
+        results.append((label, index_name, plan, index_name in plan))
+    db.session.rollback()
+    return results
+
+@app.cli.command('check-indexes')
+def check_indexes_command():
+    failed = 0
+    for label, index_name, plan, ok in check_query_plans():
+        print(f"[{'OK' if ok else 'FAIL'}] {label} -> {index_name}")
+        if not ok:
+            failed += 1
+            print('    ' + plan.replace('\n', '\n    '))
+    if failed:
+        raise SystemExit(1)
+
 def seed_music_db():
     if Track.query.first(): return
     # ПРОВЕРЕННЫЕ HTTPS ПОТОКИ
@@ -313,86 +1866,270 @@ def login():
     if user.name == "313":
         user.is_admin = True
         user.is_verified = True
+        bump_counters(User, user.id, profile_version=1)
+        bump_versions('posts', 'profiles')
         db.session.commit()
+        invalidate_auth(user)
 
     return jsonify({'user': user.to_dict(), 'token': user.secret_code})
 
+SEARCH_CANDIDATES = 50
+
+def like_escape(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def prefix_matches(query, limit):
+    q = query.lower()
+    handle_q = q if q.startswith('@') else '@' + q
+    users = User.query.filter(and_(func.lower(User.name) >= q, func.lower(User.name) < q + '\uffff')).limit(limit).all()
+    users += User.query.filter(and_(func.lower(User.handle) >= handle_q, func.lower(User.handle) < handle_q + '\uffff')).limit(limit).all()
+    return users
+
+def substring_matches(query, limit):
+    """
+    Поиск подстроки по триграммному индексу: FTS5 (trigram) на SQLite,
+    pg_trgm на Postgres. Подстроки короче трех символов индекс не покрывает.
+    """
+    if len(query) < 3: return []
+    if db.engine.dialect.name == 'sqlite':
+        rows = db.session.execute(text(
+            'SELECT id FROM user_search WHERE user_search MATCH :q LIMIT :limit'
+        ), {'q': '"' + query.replace('"', '""') + '"', 'limit': limit}).scalars().all()
+        return User.query.filter(User.id.in_(rows)).all() if rows else []
+    pattern = f"%{like_escape(query)}%"
+    return User.query.filter(or_(
+        User.name.ilike(pattern, escape='\\'),
+        User.handle.ilike(pattern, escape='\\')
+    )).limit(limit).all()
+
+def search_rank(user, query):
+    q = query.lower().lstrip('@')
+    name, handle = user.name.lower(), user.handle.lower().lstrip('@')
+    if q in (name, handle): tier = 0
+    elif name.startswith(q) or handle.startswith(q): tier = 1
+    else: tier = 2
+    return (tier, len(user.name), user.name)
+
 @app.route('/api/search', methods=['GET'])
 def search_users():
     query = request.args.get('q', '').strip()
     if not query: return jsonify([])
     
-    users = User.query.filter(
-        or_(
-            User.name.ilike(f'%{query}%'),
-            User.handle.ilike(f'%{query}%')
-        )
-    ).limit(10).all()
+    # Точные и префиксные совпадения первыми, затем подстроки
+    candidates = {u.id: u for u in prefix_matches(query, SEARCH_CANDIDATES)}
+    if len(candidates) < 10:
+        candidates.update((u.id, u) for u in substring_matches(query, SEARCH_CANDIDATES))
+    users = sorted(candidates.values(), key=lambda u: search_rank(u, query))[:10]
+    viewer = get_auth_user()
+    statuses = friend_statuses(viewer.id if viewer else None, [u.id for u in users])
     
-    return jsonify([{'name': u.name, 'handle': u.handle, 'avatar': u.avatar} for u in users])
+    return jsonify([{'id': u.id, 'name': u.name, 'handle': u.handle, 'avatar': u.avatar,
+                     'friendStatus': statuses[u.id]} for u in users])
 
 @app.route('/api/posts', methods=['GET', 'POST'])
 def handle_posts():
-    token = request.headers.get('Authorization')
-    user = User.query.filter_by(secret_code=token).first()
+    user = get_auth_user()
     if not user: return jsonify({'error': 'Unauthorized'}), 401
 
     if request.method == 'GET':
-        posts = Post.query.order_by(Post.timestamp.desc()).all()
-        return jsonify([p.to_dict(user.id) for p in posts])
+        limit = parse_limit()
+        etag = f"posts-{get_versions('posts')}-{user.id}-{limit}-{request.args.get('before', '')}"
+
+        def build():
+            posts, next_cursor = paginate_posts(Post.query, limit)
+            return {'posts': serialize_posts(posts, user.id), 'nextCursor': next_cursor}
+        return conditional_response(etag, build)
     
     if request.method == 'POST':
         data = request.json
         new_post = Post(user_id=user.id, content=data['content'], image_url=data.get('imageUrl'))
         db.session.add(new_post)
+        db.session.flush()
+        fan_out_post(new_post)
+        bump_counters(User, user.id, posts_count=1)
+        bump_versions('posts')
         db.session.commit()
         return jsonify(new_post.to_dict(user.id))
 
+def post_search_scores(query):
+    """
+    Подзапрос (id, timestamp, score) по полнотекстовому индексу постов,
+    score - чем больше, тем релевантнее. SQLite: FTS5 + bm25, Postgres:
+    GIN по to_tsvector + ts_rank_cd. None, если в запросе нет слов.
+    """
+    words = re.findall(r'\w+', query)
+    if not words: return None
+    if db.engine.dialect.name == 'sqlite':
+        # Каждое слово в кавычках (операторы FTS5 из ввода не исполняются), последнее - как префикс
+        match = ' '.join(f'"{w}"' for w in words) + '*'
+        fts = table('post_search', column('rowid'))
+        score = (-func.bm25(literal_column('post_search'))).label('score')
+        return (select(Post.id, Post.timestamp, score)
+                .select_from(fts).join(Post, Post.id == fts.c.rowid)
+                .where(literal_column('post_search').op('MATCH')(match))
+                .subquery())
+    # 'simple' литералом, чтобы выражение совпало с ix_post_content_fts
+    vector = func.to_tsvector(literal_column("'simple'"), Post.content)
+    tsquery = func.plainto_tsquery(literal_column("'simple'"), ' '.join(words))
+    return (select(Post.id, Post.timestamp, func.ts_rank_cd(vector, tsquery).label('score'))
+            .where(vector.op('@@')(tsquery))
+            .subquery())
+
+@app.route('/api/posts/trending', methods=['GET'])
+def trending_posts():
+    """Самые обсуждаемые посты окна из готового top-K; пересчета по post_like нет."""
+    user = get_auth_user()
+    if not user: return jsonify({'error': 'Unauthorized'}), 401
+    ranked = trending.top(parse_limit(default=20, maximum=trending.size))
+    posts = {p.id: p for p in Post.query.filter(Post.id.in_([pid for pid, _ in ranked]))}
+    ordered = [posts[pid] for pid, _ in ranked if pid in posts]
+    scores = dict(ranked)
+    return jsonify({'posts': [{**data, 'trendingScore': round(scores[p.id], 4)}
+                              for p, data in zip(ordered, serialize_posts(ordered, user.id))]})
+
+@app.route('/api/timeline', methods=['GET'])
+def friends_timeline():
+    """
+    Лента друзей (и своих постов) с той же пагинацией, что и /api/posts.
+    Разложенные при записи посты - один range scan по timeline; посты
+    друзей-«хабов» дочитываются по ix_post_user_timestamp_id и сливаются.
+    """
+    user = get_auth_user()
+    if not user: return jsonify({'error': 'Unauthorized'}), 401
+    limit = parse_limit()
+
+    query = Post.query.join(TimelineEntry, TimelineEntry.post_id == Post.id).filter(TimelineEntry.user_id == user.id)
+    posts, next_cursor = paginate_keyset(query, TimelineEntry.timestamp, TimelineEntry.post_id, limit,
+                                         lambda p: (p.timestamp, p.id))
+
+    graph = friend_graph.get()
+    hubs = [f for f in graph.friends(user.id) if graph.degree(f) > TIMELINE_FANOUT_MAX]
+    if hubs:
+        pulled, pulled_cursor = paginate_posts(Post.query.filter(Post.user_id.in_(hubs)), limit)
+        merged = sorted({p.id: p for p in posts + pulled}.values(), key=lambda p: (p.timestamp, p.id), reverse=True)
+        posts = merged[:limit]
+        has_more = len(merged) > limit or next_cursor or pulled_cursor
+        next_cursor = encode_cursor(posts[-1].timestamp, posts[-1].id) if has_more and posts else None
+
+    return jsonify({'posts': serialize_posts(posts, user.id), 'nextCursor': next_cursor})
+
+@app.route('/api/posts/search', methods=['GET'])
+def search_posts():
+    user = get_auth_user()
+    if not user: return jsonify({'error': 'Unauthorized'}), 401
+
+    scores = post_search_scores(request.args.get('q', ''))
+    if scores is None: return jsonify({'posts': [], 'nextCursor': None})
+    limit = parse_limit()
+
+    # Keyset по (score, timestamp, id): релевантность, при равенстве - свежесть
+    stmt = select(scores.c.id, scores.c.timestamp, scores.c.score)
+    cursor = request.args.get('before', '')
+    try:
+        score, ts, post_id = cursor.split('_', 2)
+        score, ts, post_id = float(score), datetime.fromisoformat(ts), int(post_id)
+        stmt = stmt.where(or_(
+            scores.c.score < score,
+            and_(scores.c.score == score, or_(
+                scores.c.timestamp < ts,
+                and_(scores.c.timestamp == ts, scores.c.id < post_id)
+            ))
+        ))
+    except ValueError:
+        pass
+    rows = db.session.execute(stmt.order_by(
+        scores.c.score.desc(), scores.c.timestamp.desc(), scores.c.id.desc()
+    ).limit(limit + 1)).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = f"{last.score!r}_{last.timestamp.isoformat()}_{last.id}"
+    posts = {p.id: p for p in Post.query.filter(Post.id.in_([r.id for r in rows])).all()}
+    return jsonify({
+        'posts': serialize_posts([posts[r.id] for r in rows], user.id),
+        'nextCursor': next_cursor
+    })
+
+def set_post_like(user_id, post_id, liked):
+    result = set_like(PostLike, Post, 'post_id', post_id, user_id, liked)
+    if result is None: return None
+    likes, changed, row, removed = result
+    score = None
+    if changed:
+        bump_counters(User, row.user_id, reputation=1 if liked else -1)
+        if liked:
+            score = bump_trending(post_id, row.timestamp, TRENDING_WEIGHTS['like'])
+        elif removed.timestamp:
+            # Лайки без времени (до миграции) reconcile_trending тоже не учитывает
+            score = bump_trending(post_id, row.timestamp, -TRENDING_WEIGHTS['like'], at=removed.timestamp)
+        bump_versions('posts')
+    db.session.commit()
+    if score is not None:
+        trending.offer(post_id, row.timestamp, score)
+    return likes, changed
+
+@app.route('/api/posts/<int:post_id>/like', methods=['PUT', 'DELETE'])
+def put_post_like(post_id):
+    user = get_auth_user()
+    if not user: return jsonify({'error': 'Unauthorized'}), 401
+    liked = request.method == 'PUT'
+    result = set_post_like(user.id, post_id, liked)
+    if result is None: return jsonify({'error': 'Post not found'}), 404
+    return jsonify({'likes': result[0], 'isLiked': liked})
+
 @app.route('/api/posts/<int:post_id>/like', methods=['POST'])
 def toggle_like(post_id):
-    token = request.headers.get('Authorization')
-    user = User.query.filter_by(secret_code=token).first()
+    user = get_auth_user()
     if not user: return jsonify({'error': 'Unauthorized'}), 401
-    post = Post.query.get_or_404(post_id)
-    
-    existing = PostLike.query.filter_by(user_id=user.id, post_id=post_id).first()
-    if existing:
-        db.session.delete(existing)
-        liked = False
-    else:
-        db.session.add(PostLike(user_id=user.id, post_id=post_id))
+
+    # Переключатель поверх идемпотентных операций: сначала пробуем снять лайк
+    result = set_post_like(user.id, post_id, False)
+    liked = False
+    if result is not None and not result[1]:
+        result = set_post_like(user.id, post_id, True)
         liked = True
-    db.session.commit()
-    return jsonify({'likes': post.likes_relations.count(), 'isLiked': liked})
+    if result is None: return jsonify({'error': 'Post not found'}), 404
+    return jsonify({'likes': result[0], 'isLiked': liked})
 
 @app.route('/api/posts/<int:post_id>/comments', methods=['POST'])
 def add_comment(post_id):
-    token = request.headers.get('Authorization')
-    user = User.query.filter_by(secret_code=token).first()
+    user = get_auth_user()
     if not user: return jsonify({'error': 'Unauthorized'}), 401
     content = request.json.get('content')
     if not content: return jsonify({'error': 'Empty'}), 400
-    new_comment = Comment(content=content, user_id=user.id, post_id=post_id)
+    post_timestamp = db.session.scalar(select(Post.timestamp).where(Post.id == post_id))
+    if post_timestamp is None: return jsonify({'error': 'Post not found'}), 404
+    new_comment = Comment(content=content, user_id=user.id, post_id=post_id, timestamp=datetime.utcnow())
     db.session.add(new_comment)
+    bump_counters(Post, post_id, comments_count=1)
+    score = bump_trending(post_id, post_timestamp, TRENDING_WEIGHTS['comment'], at=new_comment.timestamp)
+    bump_versions('posts')
     db.session.commit()
+    if score is not None:
+        trending.offer(post_id, post_timestamp, score)
     return jsonify(new_comment.to_dict())
 
 @app.route('/api/me/update', methods=['POST'])
 def update_profile():
-    token = request.headers.get('Authorization')
-    user = User.query.filter_by(secret_code=token).first()
-    if not user: return jsonify({'error': 'Unauthorized'}), 401
+    auth = get_auth_user()
+    if not auth: return jsonify({'error': 'Unauthorized'}), 401
+    user = db.session.get(User, auth.id)
     data = request.json
     if 'bio' in data: user.bio = data['bio']
     if 'avatar' in data: user.avatar = data['avatar']
     if 'status' in data: user.status = data['status']
+    # Данные автора встроены и в ленту, и в профили
+    bump_counters(User, user.id, profile_version=1)
+    bump_versions('posts', 'profiles')
     db.session.commit()
+    invalidate_auth(user)
     return jsonify(user.to_dict())
 
 @app.route('/api/admin/verify_toggle', methods=['POST'])
 def verify_toggle():
-    token = request.headers.get('Authorization')
-    admin = User.query.filter_by(secret_code=token).first()
+    admin = get_auth_user()
     if not admin or not admin.is_admin: return jsonify({'error': 'Forbidden'}), 403
 
     target_handle = request.json.get('handle')
@@ -400,13 +2137,21 @@ def verify_toggle():
     if not target_user: return jsonify({'error': 'User not found'}), 404
 
     target_user.is_verified = not target_user.is_verified
+    bump_counters(User, target_user.id, profile_version=1)
+    bump_versions('posts', 'profiles')
     db.session.commit()
+    invalidate_auth(target_user)
     return jsonify({'isVerified': target_user.is_verified})
 
+@app.route('/api/admin/cache_stats', methods=['GET'])
+def cache_stats():
+    admin = get_auth_user()
+    if not admin or not admin.is_admin: return jsonify({'error': 'Forbidden'}), 403
+    return jsonify({'tokens': token_cache.stats(), 'fragments': fragment_cache.stats()})
+
 @app.route('/api/friends/request', methods=['POST'])
 def send_request():
-    token = request.headers.get('Authorization')
-    sender = User.query.filter_by(secret_code=token).first()
+    sender = get_auth_user()
     if not sender: return jsonify({'error': 'Unauthorized'}), 401
     
     target_handle = request.json.get('handle')
@@ -418,36 +2163,57 @@ def send_request():
     existing = FriendRequest.query.filter_by(sender_id=sender.id, receiver_id=receiver.id).first()
     if existing: return jsonify({'status': 'pending_sent'})
 
-    if sender.friends.filter_by(id=receiver.id).first():
+    if are_friends(sender.id, receiver.id):
         return jsonify({'status': 'friends'})
 
     req = FriendRequest(sender_id=sender.id, receiver_id=receiver.id)
     db.session.add(req)
+    bump_versions('profiles')
     db.session.commit()
+    event_hub.publish('friend_request', {
+        'requestId': req.id,
+        'senderName': sender.name,
+        'senderHandle': sender.handle,
+        'senderAvatar': sender.avatar
+    }, audience={receiver.id})
     return jsonify({'status': 'pending_sent'})
 
 @app.route('/api/friends/requests', methods=['GET'])
 def get_requests():
-    token = request.headers.get('Authorization')
-    user = User.query.filter_by(secret_code=token).first()
+    user = get_auth_user()
     if not user: return jsonify({'error': 'Unauthorized'}), 401
 
-    requests = FriendRequest.query.filter_by(receiver_id=user.id).all()
-    result = []
-    for req in requests:
-        sender = User.query.get(req.sender_id)
-        result.append({
-            'requestId': req.id,
-            'senderName': sender.name,
-            'senderHandle': sender.handle,
-            'senderAvatar': sender.avatar
-        })
-    return jsonify(result)
+    if request.args.get('count_only') == '1':
+        # Для бейджа: COUNT только по индексу (receiver_id, id)
+        count = db.session.scalar(select(func.count(FriendRequest.id)).where(FriendRequest.receiver_id == user.id))
+        return jsonify({'count': count})
+
+    # Новые сверху; курсор - id последней заявки на странице
+    limit = parse_limit(default=50)
+    query = (db.session.query(FriendRequest.id, User.name, User.handle, User.avatar)
+             .join(User, User.id == FriendRequest.sender_id)
+             .filter(FriendRequest.receiver_id == user.id))
+    before = request.args.get('before', type=int)
+    if before:
+        query = query.filter(FriendRequest.id < before)
+    rows = query.order_by(FriendRequest.id.desc()).limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = str(rows[-1].id)
+    return jsonify({
+        'requests': [{
+            'requestId': req_id,
+            'senderName': name,
+            'senderHandle': handle,
+            'senderAvatar': avatar
+        } for req_id, name, handle, avatar in rows],
+        'nextCursor': next_cursor
+    })
 
 @app.route('/api/friends/respond', methods=['POST'])
 def respond_request():
-    token = request.headers.get('Authorization')
-    user = User.query.filter_by(secret_code=token).first()
+    user = get_auth_user()
     if not user: return jsonify({'error': 'Unauthorized'}), 401
 
     req_id = request.json.get('requestId')
@@ -458,79 +2224,209 @@ def respond_request():
         return jsonify({'error': 'Invalid request'}), 404
 
     if action == 'accept':
+        user = db.session.get(User, user.id)
         sender = User.query.get(freq.sender_id)
-        user.friends.append(sender)
-        sender.friends.append(user)
+        added = not are_friends(user.id, sender.id)
+        if added:
+            user.friends.append(sender)
+            sender.friends.append(user)
+            bump_counters(User, user.id, friends_count=1)
+            bump_counters(User, sender.id, friends_count=1)
+            log_friend_edge(user.id, sender.id, True)
+            link_timelines(user.id, sender.id)
         db.session.delete(freq)
     elif action == 'reject':
         db.session.delete(freq)
     
+    # Карточки авторов в лентах содержат friendsCount, а ETag лент - версия 'posts'
+    if action == 'accept' and added:
+        bump_versions('posts', 'profiles')
+    else:
+        bump_versions('profiles')
     db.session.commit()
+    if action == 'accept' and added:
+        friend_graph.apply(freq.sender_id, freq.receiver_id, True)
     return jsonify({'success': True})
 
 @app.route('/api/friends/remove', methods=['POST'])
 def remove_friend():
-    token = request.headers.get('Authorization')
-    user = User.query.filter_by(secret_code=token).first()
+    user = get_auth_user()
     if not user: return jsonify({'error': 'Unauthorized'}), 401
 
     target_handle = request.json.get('handle')
     target_user = find_user_by_handle(target_handle)
     if not target_user: return jsonify({'error': 'Not found'}), 404
 
-    if target_user in user.friends:
+    if are_friends(user.id, target_user.id):
+        user = db.session.get(User, user.id)
         user.friends.remove(target_user)
         target_user.friends.remove(user)
+        bump_counters(User, user.id, friends_count=-1)
+        bump_counters(User, target_user.id, friends_count=-1)
+        log_friend_edge(user.id, target_user.id, False)
+        unlink_timelines(user.id, target_user.id)
+        fan_out_former_hub(user.id)
+        fan_out_former_hub(target_user.id)
+        bump_versions('posts', 'profiles')
         db.session.commit()
+        friend_graph.apply(user.id, target_user.id, False)
     
     return jsonify({'success': True})
 
+def user_cards(user_ids, viewer_id, **extra):
+    """Короткие карточки в порядке user_ids: данные из fragment_cache, статус - friend_statuses."""
+    fragments = user_fragments(user_ids)
+    statuses = friend_statuses(viewer_id, user_ids)
+    cards = []
+    for uid in user_ids:
+        if uid not in fragments: continue
+        f = fragments[uid]
+        card = {'id': uid, 'name': f['name'], 'handle': f['handle'], 'avatar': f['avatar'],
+                'friendStatus': statuses[uid]}
+        cards.append({**card, **{key: values[uid] for key, values in extra.items()}})
+    return cards
+
+@app.route('/api/friends/suggestions', methods=['GET'])
+def friend_suggestions():
+    """Друзья друзей по убыванию числа общих друзей - из графа в памяти, без SQL по friends."""
+    user = get_auth_user()
+    if not user: return jsonify({'error': 'Unauthorized'}), 401
+    limit = parse_limit(default=10, maximum=50)
+    # Берем с запасом: уже отправленные заявки отсеиваются после friend_statuses
+    ranked = friend_graph.get().suggestions(user.id, limit=limit * 2)
+    mutual = dict(ranked)
+    cards = user_cards([uid for uid, _ in ranked], user.id, mutualCount=mutual)
+    return jsonify([c for c in cards if c['friendStatus'] != 'pending_sent'][:limit])
+
+@app.route('/api/users/<string:handle>/mutual', methods=['GET'])
+def get_mutual_friends(handle):
+    user = get_auth_user()
+    if not user: return jsonify({'error': 'Unauthorized'}), 401
+    target_user = find_user_by_handle(handle)
+    if not target_user: return jsonify({'error': 'User not found'}), 404
+    graph = friend_graph.get()
+    mutual = graph.mutual_friends(user.id, target_user.id)
+    return jsonify({
+        'areFriends': graph.are_friends(user.id, target_user.id),
+        'count': len(mutual),
+        'friends': user_cards(mutual[:parse_limit(default=20)], user.id)
+    })
+
+def profile_etag(kind, handle, viewer_id, *collections):
+    return (f"{kind}-{handle}-{get_versions(*collections)}-{viewer_id}"
+            f"-{request.args.get('limit', '')}-{request.args.get('before', '')}")
+
 @app.route('/api/users/<string:handle>', methods=['GET'])
 def get_user_profile(handle):
-    token = request.headers.get('Authorization')
-    current_user = User.query.filter_by(secret_code=token).first() if token else None
+    """Шапка профиля: карточка пользователя и счетчики из колонок, без списков."""
+    current_user = get_auth_user()
+    viewer_id = current_user.id if current_user else None
+    # lastSeen меняется без записей в коллекции - даем ETag устаревать раз в минуту
+    etag = f"{profile_etag('profile', handle, viewer_id, 'posts', 'profiles')}-{int(time.time() // 60)}"
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
     
     target_user = find_user_by_handle(handle)
     if not target_user: return jsonify({'error': 'User not found'}), 404
-    
-    user_posts = Post.query.filter_by(user_id=target_user.id).order_by(Post.timestamp.desc()).all()
-    liked_posts = db.session.query(Post).join(PostLike).filter(PostLike.user_id == target_user.id).order_by(PostLike.timestamp.desc()).limit(5).all()
-    friends_list = [{'id': f.id, 'name': f.name, 'handle': f.handle, 'avatar': f.avatar} for f in target_user.friends]
-
-    response = target_user.to_dict(current_user)
-    response['posts'] = [p.to_dict(current_user.id if current_user else None) for p in user_posts]
-    response['likedPosts'] = [p.to_dict(current_user.id if current_user else None) for p in liked_posts]
-    response['friendsList'] = friends_list
-    
-    return jsonify(response)
+    return with_etag(jsonify(target_user.to_dict(current_user)), etag)
+
+@app.route('/api/users/<string:handle>/posts', methods=['GET'])
+def get_user_posts(handle):
+    current_user = get_auth_user()
+    viewer_id = current_user.id if current_user else None
+    etag = profile_etag('profile-posts', handle, viewer_id, 'posts')
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
+
+    target_user = find_user_by_handle(handle)
+    if not target_user: return jsonify({'error': 'User not found'}), 404
+    posts, next_cursor = paginate_posts(Post.query.filter(Post.user_id == target_user.id), parse_limit())
+    return with_etag(jsonify({'posts': serialize_posts(posts, viewer_id), 'nextCursor': next_cursor}), etag)
+
+@app.route('/api/users/<string:handle>/liked', methods=['GET'])
+def get_user_liked_posts(handle):
+    current_user = get_auth_user()
+    viewer_id = current_user.id if current_user else None
+    etag = profile_etag('profile-liked', handle, viewer_id, 'posts')
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
+
+    target_user = find_user_by_handle(handle)
+    if not target_user: return jsonify({'error': 'User not found'}), 404
+    # Курсор по времени лайка, а не поста: порядок "недавно понравившиеся"
+    rows, next_cursor = paginate_keyset(
+        db.session.query(Post, PostLike.timestamp, PostLike.id)
+            .join(PostLike, PostLike.post_id == Post.id)
+            .filter(PostLike.user_id == target_user.id),
+        PostLike.timestamp, PostLike.id, parse_limit(default=5),
+        lambda row: (row[1], row[2])
+    )
+    return with_etag(jsonify({
+        'posts': serialize_posts([row[0] for row in rows], viewer_id),
+        'nextCursor': next_cursor
+    }), etag)
+
+@app.route('/api/users/<string:handle>/friends', methods=['GET'])
+def get_user_friends(handle):
+    current_user = get_auth_user()
+    viewer_id = current_user.id if current_user else None
+    etag = profile_etag('profile-friends', handle, viewer_id, 'profiles')
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
+
+    target_user = find_user_by_handle(handle)
+    if not target_user: return jsonify({'error': 'User not found'}), 404
+    # Порядок по friend_id - range scan по первичному ключу таблицы friends
+    limit = parse_limit(default=50)
+    query = (db.session.query(User)
+             .join(friends_table, friends_table.c.friend_id == User.id)
+             .filter(friends_table.c.user_id == target_user.id))
+    cursor = request.args.get('before')
+    if cursor:
+        query = query.filter(friends_table.c.friend_id > cursor)
+    friends = query.order_by(friends_table.c.friend_id).limit(limit + 1).all()
+    next_cursor = None
+    if len(friends) > limit:
+        friends = friends[:limit]
+        next_cursor = friends[-1].id
+    statuses = friend_statuses(viewer_id, [f.id for f in friends])
+    return with_etag(jsonify({
+        'friends': [{'id': f.id, 'name': f.name, 'handle': f.handle, 'avatar': f.avatar,
+                     'friendStatus': statuses[f.id]} for f in friends],
+        'nextCursor': next_cursor
+    }), etag)
 
 @app.route('/api/messages', methods=['GET', 'POST', 'DELETE'])
 def handle_messages():
-    token = request.headers.get('Authorization')
-    user = User.query.filter_by(secret_code=token).first()
+    user = get_auth_user()
     if not user: return jsonify({'error': 'Unauthorized'}), 401
 
     if request.method == 'DELETE':
         msg_id = request.args.get('id')
         msg = Message.query.get(msg_id)
         if msg and msg.sender_id == user.id:
+            audience = message_audience(msg)
             db.session.delete(msg)
             db.session.commit()
+            event_hub.publish('message_deleted', {'id': str(msg_id)}, audience=audience)
             return jsonify({'success': True})
         return jsonify({'error': 'Forbidden'}), 403
 
     if request.method == 'GET':
         partner_id = request.args.get('partner_id')
-        
-        if partner_id:
-            msgs = Message.query.filter(
-                or_(
-                    and_(Message.sender_id == user.id, Message.recipient_id == partner_id),
-                    and_(Message.sender_id == partner_id, Message.recipient_id == user.id)
-                )
-            ).order_by(Message.timestamp).all()
+        since_id = request.args.get('since_id', type=int)
+        before_id = request.args.get('before_id', type=int)
+        limit = parse_limit(default=100, maximum=500)
+
+        # Оба направления диалога лежат в одном диапазоне ix_message_conversation_id
+        query = (Message.query.options(joinedload(Message.sender))
+                 .filter(Message.conversation_key == Message.key_for(user.id, partner_id)))
+        if since_id is not None:
+            msgs = query.filter(Message.id > since_id).order_by(Message.id).limit(limit).all()
         else:
-            msgs = Message.query.filter(Message.recipient_id == None).order_by(Message.timestamp).limit(100).all()
+            if before_id is not None:
+                query = query.filter(Message.id < before_id)
+            msgs = query.order_by(Message.id.desc()).limit(limit).all()[::-1]
             
         return jsonify([m.to_dict(user.id) for m in msgs])
 
@@ -540,20 +2436,129 @@ def handle_messages():
         
         recipient_id = data.get('recipientId')
         
-        msg = Message(sender_id=user.id, recipient_id=recipient_id, text=data['text'])
+        msg = Message(sender_id=user.id, recipient_id=recipient_id, text=data['text'],
+                      conversation_key=Message.key_for(user.id, recipient_id))
         db.session.add(msg)
         db.session.commit()
-        return jsonify(msg.to_dict(user.id))
+        payload = msg.to_dict(user.id)
+        event_hub.publish('message', payload, audience=message_audience(msg))
+        return jsonify(payload)
+
+def poll_fingerprint(user_id):
+    # Один запрос из скалярных подзапросов, каждый - по своему индексу
+    return db.session.execute(select(
+        select(func.max(Message.id)).where(Message.conversation_key == Message.PUBLIC_KEY).scalar_subquery(),
+        select(func.max(Message.id)).where(Message.recipient_id == user_id).scalar_subquery(),
+        select(func.count(FriendRequest.id)).where(FriendRequest.receiver_id == user_id).scalar_subquery(),
+        select(func.max(FriendRequest.id)).where(FriendRequest.receiver_id == user_id).scalar_subquery()
+    )).one()
+
+def build_poll_digest(user_id, fingerprint, since_id):
+    public_last_id, _, pending_count, last_request_id = fingerprint
+    channels = {Message.PUBLIC_KEY: public_last_id}
+    unread = {}
+    for sender_id, last_id, new_count in (db.session.query(
+            Message.sender_id,
+            func.max(Message.id),
+            func.sum(case((Message.id > since_id, 1), else_=0)))
+            .filter(Message.recipient_id == user_id)
+            .group_by(Message.sender_id)):
+        channels[sender_id] = last_id
+        if new_count:
+            unread[sender_id] = int(new_count)
+
+    # Последнее входящее сообщение (общий канал или личка) - для всплывающего уведомления
+    candidates = [
+        Message.query.filter(Message.conversation_key == Message.PUBLIC_KEY, Message.sender_id != user_id)
+            .order_by(Message.id.desc()).first(),
+        Message.query.filter(Message.recipient_id == user_id).order_by(Message.id.desc()).first()
+    ]
+    last = max((m for m in candidates if m), key=lambda m: m.id, default=None)
+
+    return {
+        'channels': channels,
+        'unread': unread,
+        'pendingRequests': pending_count,
+        # Число заявок может не измениться (одна принята, одна пришла) - клиент сверяет и id
+        'lastRequestId': last_request_id,
+        'lastMessage': {
+            'id': str(last.id),
+            'senderName': last.sender.name,
+            'text': last.text,
+            'isDirect': last.recipient_id is not None
+        } if last else None
+    }
+
+@app.route('/api/poll', methods=['GET'])
+def poll_digest():
+    """
+    Сводка для фонового опроса клиента: последний id по каждому каналу,
+    непрочитанные личные сообщения (id > since_id) и число входящих заявок.
+    Если ничего не изменилось - 304 после единственного индексного запроса.
+    """
+    user = get_auth_user()
+    if not user: return jsonify({'error': 'Unauthorized'}), 401
+
+    since_id = request.args.get('since_id', 0, type=int)
+    fingerprint = poll_fingerprint(user.id)
+    etag = hashlib.sha1(repr((user.id, since_id, tuple(fingerprint))).encode()).hexdigest()
+    return conditional_response(etag, lambda: build_poll_digest(user.id, fingerprint, since_id))
+
+@app.route('/api/stream/ticket', methods=['POST'])
+def stream_ticket():
+    user = get_auth_user()
+    if not user: return jsonify({'error': 'Unauthorized'}), 401
+    return jsonify({'ticket': issue_stream_ticket(user.id, request.headers['Authorization']),
+                    'expiresIn': STREAM_TICKET_TTL})
+
+@app.route('/api/stream', methods=['GET'])
+def stream_events():
+    # Браузер подключается по короткоживущему билету из /api/stream/ticket
+    user = get_auth_user() or resolve_stream_ticket(request.args.get('ticket'))
+    if not user: return jsonify({'error': 'Unauthorized'}), 401
+
+    try:
+        last_event_id = int(request.headers.get('Last-Event-ID') or request.args.get('lastEventId'))
+    except (TypeError, ValueError):
+        last_event_id = None
+    sub, replay = event_hub.subscribe(user.id, last_event_id)
+    # Соединение держится долго - отдаем сессию БД до начала стрима
+    db.session.remove()
+
+    def generate():
+        try:
+            yield "retry: 3000\n\n"
+            if replay is None:
+                yield "event: reset\ndata: {}\n\n"
+            else:
+                for item in replay:
+                    yield format_sse(item, sub.user_id)
+            while True:
+                if sub.lagged:
+                    sub.lagged = False
+                    yield "event: reset\ndata: {}\n\n"
+                try:
+                    item = sub.queue.get(timeout=15)
+                except queue.Empty:
+                    yield ": ping\n\n"
+                    continue
+                yield format_sse(item, sub.user_id)
+        finally:
+            event_hub.unsubscribe(sub)
+
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
 
 @app.route('/api/music', methods=['GET', 'POST'])
 def handle_music():
-    token = request.headers.get('Authorization')
-    user = User.query.filter_by(secret_code=token).first()
+    user = get_auth_user()
     if not user: return jsonify({'error': 'Unauthorized'}), 401
     
     if request.method == 'GET':
-        tracks = Track.query.all()
-        return jsonify([t.to_dict(user.id) for t in tracks])
+        etag = f"music-{get_versions('music')}-{user.id}"
+        return conditional_response(etag, lambda: [t.to_dict(user.id) for t in Track.query.all()])
 
     if request.method == 'POST':
         data = request.json
@@ -568,24 +2573,108 @@ def handle_music():
             added_by=user.id
         )
         db.session.add(new_track)
+        bump_versions('music')
         db.session.commit()
         return jsonify(new_track.to_dict(user.id))
 
+def set_track_like(user_id, track_id, liked):
+    result = set_like(TrackLike, Track, 'track_id', track_id, user_id, liked)
+    if result is None: return None
+    likes, changed, _, _ = result
+    if changed:
+        bump_versions('music')
+    db.session.commit()
+    return likes, changed
+
+@app.route('/api/music/<int:track_id>/like', methods=['PUT', 'DELETE'])
+def put_track_like(track_id):
+    user = get_auth_user()
+    if not user: return jsonify({'error': 'Unauthorized'}), 401
+    liked = request.method == 'PUT'
+    result = set_track_like(user.id, track_id, liked)
+    if result is None: return jsonify({'error': 'Track not found'}), 404
+    return jsonify({'likes': result[0], 'isLiked': liked})
+
 @app.route('/api/music/<int:track_id>/like', methods=['POST'])
 def like_track(track_id):
-    token = request.headers.get('Authorization')
-    user = User.query.filter_by(secret_code=token).first()
+    user = get_auth_user()
     if not user: return jsonify({'error': 'Unauthorized'}), 401
     
-    existing = TrackLike.query.filter_by(user_id=user.id, track_id=track_id).first()
-    if existing:
-        db.session.delete(existing)
-        liked = False
-    else:
-        db.session.add(TrackLike(user_id=user.id, track_id=track_id))
+    result = set_track_like(user.id, track_id, False)
+    liked = False
+    if result is not None and not result[1]:
+        result = set_track_like(user.id, track_id, True)
         liked = True
-    db.session.commit()
-    return jsonify({'isLiked': liked})
+    if result is None: return jsonify({'error': 'Track not found'}), 404
+    return jsonify({'isLiked': liked, 'likes': result[0]})
+
+# --- BATCH ---
+BATCH_MAX_REQUESTS = 20
+BATCH_FORBIDDEN = ('/api/batch', '/api/stream')
+BATCH_FORWARDED_HEADERS = ('If-None-Match',)
+
+@app.route('/api/batch', methods=['POST'])
+def batch():
+    """
+    Несколько запросов к существующим эндпоинтам за один round trip:
+    {"requests": [{"method": "GET", "path": "/api/posts?limit=10", "body": {...}}, ...]}
+    Авторизация выполняется один раз, все подзапросы идут в одном контексте
+    приложения и одной сессии БД. Чтения делят одну транзакцию; эндпоинты
+    записи коммитят каждый сам, как и при отдельном вызове, потому что после
+    коммита рассылают события и сбрасывают кэши. Ответы - в исходном порядке.
+    """
+    user = get_auth_user()
+    if not user: return jsonify({'error': 'Unauthorized'}), 401
+    items = (request.json or {}).get('requests')
+    if not isinstance(items, list) or not items:
+        return jsonify({'error': 'requests must be a non-empty list'}), 400
+    if len(items) > BATCH_MAX_REQUESTS:
+        return jsonify({'error': f'At most {BATCH_MAX_REQUESTS} requests per batch'}), 400
+
+    token = request.headers.get('Authorization')
+    results = []
+    for item in items:
+        if not isinstance(item, dict):
+            results.append({'status': 400, 'body': {'error': 'Malformed request'}})
+            continue
+        method = str(item.get('method', 'GET')).upper()
+        path = str(item.get('path', ''))
+        if not path.startswith('/api/') or path.split('?')[0].startswith(BATCH_FORBIDDEN):
+            results.append({'status': 400, 'body': {'error': 'Unsupported path'}})
+            continue
+        item_headers = item.get('headers') or {}
+        if not isinstance(item_headers, dict):
+            results.append({'status': 400, 'body': {'error': 'headers must be an object'}})
+            continue
+        headers = {'Authorization': token}
+        headers.update({h: str(item_headers[h]) for h in BATCH_FORWARDED_HEADERS if h in item_headers})
+        # Контекст приложения (а с ним g.auth_user и сессия БД) переиспользуется
+        with app.test_request_context(path, method=method, json=item.get('body'), headers=headers):
+            try:
+                response = app.full_dispatch_request()
+            except Exception as e:
+                # Необработанное исключение подзапроса не должно ронять весь пакет:
+                # предыдущие подзапросы уже закоммичены, клиент должен видеть, какие
+                print(f"Batch item {method} {path} failed: {e!r}")
+                response = None
+            child_stats = sql_stats()
+        sql_stats().merge(child_stats)
+        if response is None or response.status_code >= 500:
+            db.session.rollback()
+        if response is None:
+            results.append({'status': 500, 'body': {'error': 'Internal server error'}})
+            continue
+        result = {'status': response.status_code, 'body': response.get_json(silent=True)}
+        if response.headers.get('ETag'):
+            result['etag'] = response.headers['ETag']
+        results.append(result)
+    return jsonify({'responses': results})
+
+@app.route('/api/metrics', methods=['GET'])
+def metrics_endpoint():
+    if METRICS_TOKEN and METRICS_TOKEN not in (request.args.get('token'), request.headers.get('Authorization', '').removeprefix('Bearer ')):
+        return jsonify({'error': 'Forbidden'}), 403
+    return Response(render_metrics(*metrics.collect()), content_type='text/plain; version=0.0.4; charset=utf-8')
 
 # --- НОВЫЙ ENDPOINT ДЛЯ KEEP-ALIVE ---
 
@@ -614,13 +2703,22 @@ def keep_alive_ping():
 
 # --- ЗАПУСК СЕРВЕРА ---
 # Этот блок тоже должен быть "прижат" к левому краю
-if __name__ == '__main__':
+def prepare_database():
+    """Схема, миграции и стартовые треки; при запуске под gunicorn - из gunicorn.conf.py."""
     with app.app_context():
         db.create_all()
+        run_migrations()
         seed_music_db()
+
+if __name__ == '__main__':
+    prepare_database()
+    with app.app_context():
+        friend_graph.get()
     
     # Запускаем бота
-    threading.Thread(target=keep_alive_ping, daemon=True).start()
+    keep_alive = threading.Thread(target=keep_alive_ping, name='keep-alive', daemon=True)
+    keep_alive.start()
+    background_threads['keep-alive'] = keep_alive
 
     print("--- NEURAL SERVER STARTED ON PORT 5000 ---")
     app.run(debug=True, port=5000)